@@ -0,0 +1,264 @@
+# coding=utf-8
+"""
+Stand-ins for what OctoPrint and python-periphery provide at runtime.
+
+install_fake_periphery() must run before octoprint_psucontrol is imported so
+the plugin picks up the fake module and the benchmarks behave the same on any
+Linux box, GPIO or not. The fake chip reports no v2 uAPI and no edge support,
+so GPIOLineGroup opens one fake line per pin and the sense pin is polled.
+"""
+from __future__ import absolute_import
+
+__author__ = "Shawn Bruce <kantlivelong@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2021 Shawn Bruce - Released under terms of the AGPLv3 License"
+
+import logging
+import os
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# (path, line) -> level, shared by every fake line so a test can drive inputs.
+LINE_LEVELS = dict()
+
+
+class _GPIOError(IOError):
+    pass
+
+
+class _FakeCdevGPIO(object):
+    def __init__(self, path, line, direction, edge='none', bias='default'):
+        if edge != 'none':
+            raise _GPIOError(95, "Edge detection is not supported by the fake GPIO chip")
+
+        self.path = path
+        self.line = line
+        self.name = "{}:{}".format(path, line)
+        self.edge = edge
+        self.fd = None
+
+        if direction in ('high', 'low'):
+            LINE_LEVELS[(path, line)] = direction == 'high'
+
+    def read(self):
+        return LINE_LEVELS.get((self.path, self.line), False)
+
+    def write(self, value):
+        LINE_LEVELS[(self.path, self.line)] = bool(value)
+
+    def poll(self, timeout=None):
+        return False
+
+    def read_event(self):
+        raise _GPIOError(95, "No edge events on the fake GPIO chip")
+
+    def close(self):
+        pass
+
+
+class _FakeCdev2GPIO(object):
+    SUPPORTED = False
+
+    _GPIO_V2_LINE_ATTR_ID_OUTPUT_VALUES = 0x2
+    _GPIO_V2_LINE_FLAG_INPUT = 0x4
+    _GPIO_V2_LINE_FLAG_OUTPUT = 0x8
+    _GPIO_V2_LINE_FLAG_EDGE_RISING = 0x10
+    _GPIO_V2_LINE_FLAG_EDGE_FALLING = 0x20
+    _GPIO_V2_LINE_FLAG_BIAS_PULL_UP = 0x100
+    _GPIO_V2_LINE_FLAG_BIAS_PULL_DOWN = 0x200
+    _GPIO_V2_LINE_FLAG_BIAS_DISABLED = 0x400
+
+
+def install_fake_periphery():
+    if 'octoprint_psucontrol' in sys.modules:
+        raise RuntimeError("install_fake_periphery() must be called before octoprint_psucontrol is imported")
+
+    gpio_cdev2 = types.ModuleType('periphery.gpio_cdev2')
+    gpio_cdev2.Cdev2GPIO = _FakeCdev2GPIO
+
+    periphery = types.ModuleType('periphery')
+    periphery.version = "fake"
+    periphery.GPIOError = _GPIOError
+    periphery.CdevGPIO = _FakeCdevGPIO
+    periphery.GPIO = _FakeCdevGPIO
+    periphery.gpio_cdev2 = gpio_cdev2
+
+    sys.modules['periphery'] = periphery
+    sys.modules['periphery.gpio_cdev2'] = gpio_cdev2
+
+
+class Settings(object):
+    def __init__(self, values):
+        self._values = values
+        self._scripts = dict()
+
+    def get(self, path, **kwargs):
+        return self._values.get(path[0])
+
+    get_int = get_float = get_boolean = get
+
+    def set(self, path, value, **kwargs):
+        self._values[path[0]] = value
+
+    set_int = set_float = set_boolean = set
+
+    def listScripts(self, script_type):
+        return list(self._scripts.keys())
+
+    def saveScript(self, script_type, name, script):
+        self._scripts[name] = script
+
+
+class Printer(object):
+    def __init__(self):
+        self.closed = True
+        self.temperatures = dict()
+        self.ports = ['/dev/ttyUSB0']
+        self.on_event = None
+
+    def commands(self, commands, **kwargs):
+        pass
+
+    def script(self, name, **kwargs):
+        pass
+
+    def is_closed_or_error(self):
+        return self.closed
+
+    def is_operational(self):
+        return not self.closed
+
+    def is_printing(self):
+        return False
+
+    def is_paused(self):
+        return False
+
+    def connect(self, *args, **kwargs):
+        from octoprint.events import Events
+
+        self.closed = False
+        if self.on_event is not None:
+            self.on_event(Events.CONNECTED, dict())
+
+    def disconnect(self):
+        self.closed = True
+
+    def get_connection_options(self):
+        return dict(ports=list(self.ports), portPreference=None)
+
+    def get_current_temperatures(self):
+        return self.temperatures
+
+    def set_temperature(self, heater, value):
+        self.temperatures.setdefault(heater, dict())['target'] = value
+
+    def register_callback(self, callback):
+        pass
+
+    def unregister_callback(self, callback):
+        pass
+
+
+class EventBus(object):
+    def fire(self, event, payload=None):
+        pass
+
+
+class PluginManager(object):
+    def __init__(self):
+        self.plugin_implementations = dict()
+        self.plugins = dict()
+
+    def send_plugin_message(self, identifier, data):
+        pass
+
+
+class Comm(object):
+    def _log(self, message):
+        pass
+
+
+class SubPlugin(object):
+    """A sensing/switching sub-plugin that answers immediately."""
+
+    def __init__(self):
+        self.state = False
+
+    def get_psu_state(self):
+        return self.state
+
+    def turn_psu_on(self):
+        self.state = True
+
+    def turn_psu_off(self):
+        self.state = False
+
+
+_DATA_ROOT = None
+
+
+def _data_root():
+    # One directory for the whole run, removed again when the interpreter exits.
+    global _DATA_ROOT
+    if _DATA_ROOT is None:
+        _DATA_ROOT = tempfile.TemporaryDirectory(prefix="psucontrol-bench-")
+    return _DATA_ROOT
+
+
+def build_plugin(overrides=None, sub_plugins=None):
+    from octoprint.events import Events
+    from octoprint_psucontrol import PSUControl
+
+    # Normally added by OctoPrint from register_custom_events.
+    for event in ("psu_state_changed", "channel_state_changed"):
+        name = "PLUGIN_PSUCONTROL_{}".format(event.upper())
+        if not hasattr(Events, name):
+            setattr(Events, name, "plugin_psucontrol_{}".format(event))
+
+    plugin = PSUControl()
+    plugin._identifier = "psucontrol"
+    plugin._data_folder = tempfile.mkdtemp(dir=_data_root().name)
+    plugin._logger = logging.getLogger("psucontrol.bench")
+    plugin._logger.disabled = True
+
+    values = plugin.get_settings_defaults()
+    values.update(overrides or dict())
+    plugin._settings = Settings(values)
+    plugin._printer = Printer()
+    plugin._printer.on_event = plugin.on_event
+    plugin._event_bus = EventBus()
+    plugin._plugin_manager = PluginManager()
+    plugin.on_settings_initialized()
+
+    for key, implementation in (sub_plugins or dict()).items():
+        plugin._plugin_manager.plugin_implementations[key] = implementation
+        plugin.register_plugin(implementation)
+
+    return plugin
+
+
+def best_ns_per_call(fn, calls, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        for _ in range(calls):
+            fn()
+        elapsed = time.perf_counter_ns() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best / float(calls)
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
@@ -0,0 +1,80 @@
+# coding=utf-8
+"""
+Cost of one PSU state check cycle for each sensing method.
+
+Runs PSUControl._update_psu_state followed by _schedule_poll, which is what
+the sensing thread does every time it wakes up, in steady state (no state
+change). GPIO lines come from the fake chip in _stubs.
+
+Usage: python benchmarks/bench_check_cycle.py [--cycles N] [--repeat N]
+"""
+from __future__ import absolute_import, print_function
+
+__author__ = "Shawn Bruce <kantlivelong@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2021 Shawn Bruce - Released under terms of the AGPLv3 License"
+
+import argparse
+
+import _stubs
+_stubs.install_fake_periphery()
+
+_GPIO_CHANNELS = [
+    dict(name="ch{}".format(i), switchingMethod='GPIO', onoffGPIOPin=10 + i, sensingMethod='GPIO', senseGPIOPin=20 + i, senseGPIOPinEdgeDetection=False)
+    for i in range(3)
+]
+
+# (name, settings, sub plugins, relative cost) - subprocess based methods get fewer cycles.
+SCENARIOS = [
+    ("internal", dict(sensingMethod='INTERNAL'), None, 1),
+    ("gpio", dict(GPIODevice='/dev/gpiochip0', switchingMethod='GPIO', onoffGPIOPin=5, sensingMethod='GPIO', senseGPIOPin=6, senseGPIOPinEdgeDetection=False), None, 1),
+    ("gpio x4 channels", dict(GPIODevice='/dev/gpiochip0', switchingMethod='GPIO', onoffGPIOPin=5, sensingMethod='GPIO', senseGPIOPin=6, senseGPIOPinEdgeDetection=False, channels=_GPIO_CHANNELS), None, 1),
+    ("plugin", dict(sensingMethod='PLUGIN', sensingPlugin='bench'), dict(bench=_stubs.SubPlugin()), 20),
+    ("system persistent", dict(sensingMethod='SYSTEM', senseSystemCommand="sh -c 'while read l; do echo on; done'", senseSystemCommandPersistent=True), None, 50),
+    ("system", dict(sensingMethod='SYSTEM', senseSystemCommand='true'), None, 1000),
+]
+
+
+def measure(overrides, sub_plugins, cycles, repeat):
+    plugin = _stubs.build_plugin(overrides, sub_plugins)
+    if plugin._uses_gpio():
+        plugin.configure_gpio()
+
+    def cycle():
+        plugin._update_psu_state()
+        plugin._schedule_poll()
+
+    # Settle first so every measured cycle is a steady state one.
+    cycle()
+    result = _stubs.best_ns_per_call(cycle, cycles, repeat)
+
+    plugin._executor.stop_persistent()
+    plugin.cleanup_gpio()
+    if plugin._pollTimer is not None:
+        plugin._pollTimer.cancel()
+
+    return result / 1000.0
+
+
+def run(cycles=2000, repeat=5):
+    results = []
+    for name, overrides, sub_plugins, cost in SCENARIOS:
+        value = measure(overrides, sub_plugins, max(1, cycles // cost), repeat)
+        results.append(("check_cycle/{}".format(name), value, "us/cycle"))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--cycles", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print("{:<36} {:>12}".format("scenario", "us/cycle"))
+    for name, value, _ in run(args.cycles, args.repeat):
+        print("{:<36} {:>12.1f}".format(name, value))
+
+
+if __name__ == "__main__":
+    main()
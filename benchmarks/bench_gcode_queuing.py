@@ -0,0 +1,126 @@
+# coding=utf-8
+"""
+Per-line cost of PSUControl.hook_gcode_queuing.
+
+Builds the plugin against minimal stand-ins for the objects OctoPrint normally
+injects and feeds it representative G-code mixes, reporting nanoseconds per
+queued line for a handful of feature combinations.
+
+Usage: python benchmarks/bench_gcode_queuing.py [--lines N] [--repeat N]
+"""
+from __future__ import absolute_import, print_function
+
+__author__ = "Shawn Bruce <kantlivelong@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2021 Shawn Bruce - Released under terms of the AGPLv3 License"
+
+import argparse
+import random
+import time
+
+import _stubs
+_stubs.install_fake_periphery()
+
+
+def _job_fdm(rng, n):
+    lines = []
+    for i in range(n):
+        r = rng.random()
+        if r < 0.90:
+            lines.append(("G1 X{:.3f} Y{:.3f} E{:.5f}".format(rng.uniform(0, 200), rng.uniform(0, 200), rng.uniform(0, 2)), "G1"))
+        elif r < 0.97:
+            lines.append(("G0 F9000 X{:.3f} Y{:.3f}".format(rng.uniform(0, 200), rng.uniform(0, 200)), "G0"))
+        elif r < 0.99:
+            lines.append(("M106 S255", "M106"))
+        else:
+            lines.append(("M105", "M105"))
+    return lines
+
+
+def _job_arc(rng, n):
+    lines = []
+    for i in range(n):
+        g = "G2" if rng.random() < 0.5 else "G3"
+        lines.append(("{} X{:.3f} Y{:.3f} I{:.3f} J{:.3f} E{:.5f}".format(g, rng.uniform(0, 200), rng.uniform(0, 200), rng.uniform(-5, 5), rng.uniform(-5, 5), rng.uniform(0, 1)), g))
+    return lines
+
+
+def _job_laser(rng, n):
+    lines = []
+    for i in range(n):
+        r = rng.random()
+        if r < 0.95:
+            lines.append(("G1 X{:.2f} Y{:.2f} S{}".format(rng.uniform(0, 300), rng.uniform(0, 300), rng.randint(0, 1000)), "G1"))
+        elif r < 0.98:
+            lines.append(("M3 S1000", "M3"))
+        else:
+            lines.append(("M5", "M5"))
+    return lines
+
+
+JOBS = [
+    ("fdm", _job_fdm),
+    ("arc", _job_arc),
+    ("laser", _job_laser),
+]
+
+SCENARIOS = [
+    ("all disabled", dict()),
+    ("idle power off", dict(powerOffWhenIdle=True)),
+    ("auto on + idle", dict(autoOn=True, powerOffWhenIdle=True)),
+    ("pseudo + auto on + idle", dict(switchingMethod='SYSTEM', enablePseudoOnOff=True, autoOn=True, powerOffWhenIdle=True)),
+]
+
+
+def build_plugin(overrides):
+    plugin = _stubs.build_plugin(overrides)
+
+    # Steady state of a running job: the PSU is already on.
+    plugin.isPSUOn = True
+    return plugin
+
+
+def measure(plugin, lines, repeat):
+    hook = plugin.hook_gcode_queuing
+    comm = _stubs.Comm()
+    best = None
+
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        for cmd, gcode in lines:
+            hook(comm, "queuing", cmd, None, gcode)
+        elapsed = time.perf_counter_ns() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best / float(len(lines))
+
+
+def run(lines=100000, repeat=5):
+    results = []
+    for scenario, overrides in SCENARIOS:
+        plugin = build_plugin(overrides)
+        for name, job in JOBS:
+            commands = job(random.Random(name), lines)
+            results.append(("gcode_queuing/{}/{}".format(scenario, name), measure(plugin, commands, repeat), "ns/line"))
+        plugin._stop_idle_timer()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--lines", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    results = dict((name, value) for name, value, _ in run(args.lines, args.repeat))
+
+    print("{:<26} {:>10} {:>10} {:>10}".format("scenario (ns/line)", *[name for name, _ in JOBS]))
+    for scenario, _ in SCENARIOS:
+        print("{:<26} {:>10.1f} {:>10.1f} {:>10.1f}".format(scenario, *[results["gcode_queuing/{}/{}".format(scenario, name)] for name, _ in JOBS]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# coding=utf-8
+"""
+Cost of PSUControl._reset_idle_timer, quiet and under load.
+
+"Under load" runs state check cycles on another thread every millisecond and keeps
+a few thousand pending jobs in the scheduler, so the reset competes with the
+other plugin threads for the GIL the way it does during a busy print.
+
+Usage: python benchmarks/bench_idle_reset.py [--calls N] [--repeat N]
+"""
+from __future__ import absolute_import, print_function
+
+__author__ = "Shawn Bruce <kantlivelong@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2021 Shawn Bruce - Released under terms of the AGPLv3 License"
+
+import argparse
+import threading
+
+import _stubs
+_stubs.install_fake_periphery()
+
+PENDING_JOBS = 5000
+
+
+def build_plugin(overrides=None):
+    settings = dict(powerOffWhenIdle=True, idleTimeout=30)
+    settings.update(overrides or dict())
+
+    plugin = _stubs.build_plugin(settings)
+    plugin.isPSUOn = True
+    plugin._start_idle_timer()
+    return plugin
+
+
+def measure_quiet(calls, repeat):
+    plugin = build_plugin()
+    result = _stubs.best_ns_per_call(plugin._reset_idle_timer, calls, repeat)
+    plugin._stop_idle_timer()
+    return result
+
+
+def measure_loaded(calls, repeat):
+    plugin = build_plugin(dict(sensingMethod='INTERNAL'))
+
+    jobs = [plugin._scheduler.schedule(3600 + i, lambda: None) for i in range(PENDING_JOBS)]
+
+    stop = threading.Event()
+
+    def check_loop():
+        while not stop.is_set():
+            plugin._update_psu_state()
+            stop.wait(0.001)
+
+    thread = threading.Thread(target=check_loop)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        result = _stubs.best_ns_per_call(plugin._reset_idle_timer, calls, repeat)
+    finally:
+        stop.set()
+        thread.join()
+        for job in jobs:
+            job.cancel()
+        plugin._stop_idle_timer()
+
+    return result
+
+
+def run(calls=200000, repeat=5):
+    return [
+        ("idle_reset/quiet", measure_quiet(calls, repeat), "ns/call"),
+        ("idle_reset/under load", measure_loaded(calls, repeat), "ns/call"),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--calls", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print("{:<36} {:>12}".format("scenario", "ns/call"))
+    for name, value, _ in run(args.calls, args.repeat):
+        print("{:<36} {:>12.1f}".format(name, value))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# coding=utf-8
+"""
+On/Off round trip latency through the switching worker.
+
+Each round trip is turn_psu_on().wait() followed by turn_psu_off().wait(),
+so it includes the settle time the plugin always waits after switching
+(postOnDelay is set to 0). Also reports how long submitting a switch takes
+for the caller, which is what API requests and the auto on hook see.
+
+Usage: python benchmarks/bench_switching.py [--rounds N]
+"""
+from __future__ import absolute_import, print_function
+
+__author__ = "Shawn Bruce <kantlivelong@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2021 Shawn Bruce - Released under terms of the AGPLv3 License"
+
+import argparse
+import time
+
+import _stubs
+_stubs.install_fake_periphery()
+
+SCENARIOS = [
+    ("gpio", dict(GPIODevice='/dev/gpiochip0', switchingMethod='GPIO', onoffGPIOPin=5, sensingMethod='INTERNAL')),
+    ("system", dict(switchingMethod='SYSTEM', onSysCommand='true', offSysCommand='true', sensingMethod='INTERNAL')),
+    ("plugin", dict(switchingMethod='PLUGIN', switchingPlugin='bench', sensingMethod='INTERNAL')),
+]
+
+
+def measure(overrides, rounds):
+    settings = dict(postOnDelay=0.0, connectOnPowerOn=False, disconnectOnPowerOff=False, sensePollingInterval=60)
+    settings.update(overrides)
+
+    plugin = _stubs.build_plugin(settings, dict(bench=_stubs.SubPlugin()))
+    plugin.on_after_startup()
+
+    round_trips = []
+    submits = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        op = plugin.turn_psu_on()
+        submits.append(time.perf_counter() - start)
+        op.wait()
+
+        start_off = time.perf_counter()
+        op = plugin.turn_psu_off()
+        submits.append(time.perf_counter() - start_off)
+        op.wait()
+
+        round_trips.append(time.perf_counter() - start)
+
+    plugin._executor.stop_persistent()
+    plugin.cleanup_gpio()
+
+    return _stubs.median(round_trips) * 1000.0, _stubs.median(submits) * 1000000.0
+
+
+def run(rounds=10):
+    results = []
+    for name, overrides in SCENARIOS:
+        round_trip, submit = measure(overrides, rounds)
+        results.append(("switching/{}/round trip".format(name), round_trip, "ms"))
+        results.append(("switching/{}/submit".format(name), submit, "us"))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+
+    print("{:<36} {:>12}".format("scenario", "median"))
+    for name, value, unit in run(args.rounds):
+        print("{:<36} {:>9.2f} {:<2}".format(name, value, unit))
+
+
+if __name__ == "__main__":
+    main()
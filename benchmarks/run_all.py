@@ -0,0 +1,119 @@
+# coding=utf-8
+"""
+Run every PSUControl benchmark and optionally compare against a baseline.
+
+Results are written with --json so they can be kept per commit; --compare
+reads an earlier result file and exits non-zero when any benchmark got slower
+than --threshold percent. All benchmarks report lower-is-better figures.
+Microbenchmarks use the best of several runs and round trips use the median,
+which keeps runs on the same machine comparable.
+
+Usage:
+    python benchmarks/run_all.py --json results/HEAD.json
+    python benchmarks/run_all.py --compare results/base.json --threshold 10
+"""
+from __future__ import absolute_import, print_function
+
+__author__ = "Shawn Bruce <kantlivelong@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2021 Shawn Bruce - Released under terms of the AGPLv3 License"
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+
+import _stubs
+_stubs.install_fake_periphery()
+
+import bench_check_cycle
+import bench_gcode_queuing
+import bench_idle_reset
+import bench_switching
+
+# module, full arguments, --quick arguments
+BENCHMARKS = [
+    (bench_gcode_queuing, dict(), dict(lines=20000, repeat=3)),
+    (bench_check_cycle, dict(), dict(cycles=500, repeat=3)),
+    (bench_idle_reset, dict(), dict(calls=50000, repeat=3)),
+    (bench_switching, dict(), dict(rounds=3)),
+]
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+
+    print()
+    print("{:<48} {:>12} {:>12} {:>8}".format("benchmark", "baseline", "current", "change"))
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None or base['unit'] != result['unit'] or not base['value']:
+            print("{:<48} {:>12} {:>12.2f} {:>8}".format(name, "-", result['value'], "new"))
+            continue
+
+        change = (result['value'] - base['value']) / base['value'] * 100.0
+        flag = ""
+        if change > threshold:
+            flag = " REGRESSION"
+            regressions.append(name)
+        print("{:<48} {:>12.2f} {:>12.2f} {:>+7.1f}%{}".format(name, base['value'], result['value'], change, flag))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="Fewer iterations, for a fast sanity check.")
+    parser.add_argument("--json", metavar="PATH", help="Write the results to PATH.")
+    parser.add_argument("--compare", metavar="PATH", help="Compare against results previously written with --json.")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Allowed slowdown in percent before --compare fails (default: 10).")
+    args = parser.parse_args()
+
+    results = dict()
+    for module, full, quick in BENCHMARKS:
+        for name, value, unit in module.run(**(quick if args.quick else full)):
+            print("{:<48} {:>12.2f} {}".format(name, value, unit))
+            results[name] = dict(value=value, unit=unit)
+
+    if args.json:
+        data = dict(
+            meta=dict(
+                commit=_git_commit(),
+                python=platform.python_version(),
+                implementation=platform.python_implementation(),
+                platform=platform.platform(),
+                quick=args.quick,
+                timestamp=datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z",
+            ),
+            results=results,
+        )
+        with open(args.json, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        if baseline['meta'].get('quick') != args.quick:
+            print("Warning: comparing quick and full runs", file=sys.stderr)
+
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print("\n{} benchmark(s) regressed by more than {}%".format(len(regressions), args.threshold))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,9 @@ __author__ = "Shawn Bruce <kantlivelong@gmail.com>"
 __license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
 __copyright__ = "Copyright (C) 2021 Shawn Bruce - Released under terms of the AGPLv3 License"
 
+import concurrent.futures
+import threading
+
 import octoprint.plugin
 
 class PSUControl_SubPluginExample(octoprint.plugin.StartupPlugin,
@@ -12,26 +15,69 @@ class PSUControl_SubPluginExample(octoprint.plugin.StartupPlugin,
 
     def __init__(self):
         self.status = False
+        self._psucontrol = None
 
 
     def on_startup(self, host, port):
         psucontrol_helpers = self._plugin_manager.get_helpers("psucontrol")
-        if not psucontrol_helpers or 'register_plugin' not in psucontrol_helpers.keys():
+        if not psucontrol_helpers:
             self._logger.warning("The version of PSUControl that is installed does not support plugin registration.")
             return
 
-        self._logger.debug("Registering plugin with PSUControl")
-        psucontrol_helpers['register_plugin'](self)
+        if 'register_plugin_v2' in psucontrol_helpers.keys():
+            # v2: callbacks are looked up once and the state is pushed with
+            # notify_psu_state() instead of PSUControl polling get_psu_state.
+            self._logger.debug("Registering plugin with PSUControl (v2)")
+            self._psucontrol = psucontrol_helpers['register_plugin_v2'](self, push=True)
+            self._notify_psu_state()
+        elif 'register_plugin' in psucontrol_helpers.keys():
+            self._logger.debug("Registering plugin with PSUControl")
+            psucontrol_helpers['register_plugin'](self)
+        else:
+            self._logger.warning("The version of PSUControl that is installed does not support plugin registration.")
+
+
+    def _notify_psu_state(self):
+        if self._psucontrol is not None:
+            self._psucontrol.notify_psu_state(self.status)
+
+
+    def _switch_later(self, status, delay=0.5):
+        # Stands in for a device that confirms the switch asynchronously, e.g. a smart plug
+        # reporting back over MQTT. PSUControl waits on the returned future.
+        future = concurrent.futures.Future()
+
+        def complete():
+            self.status = status
+            self._notify_psu_state()
+            future.set_result(True)
+
+        threading.Timer(delay, complete).start()
+        return future
+
+
+    # Used by PSUControl versions that support register_plugin_v2.
+    def turn_psu_on_async(self):
+        self._logger.info("ON (async)")
+        return self._switch_later(True)
+
+
+    def turn_psu_off_async(self):
+        self._logger.info("OFF (async)")
+        return self._switch_later(False)
 
 
+    # Used by older PSUControl versions.
     def turn_psu_on(self):
         self._logger.info("ON")
         self.status = True
+        self._notify_psu_state()
 
 
     def turn_psu_off(self):
         self._logger.info("OFF")
         self.status = False
+        self._notify_psu_state()
 
 
     def get_psu_state(self):
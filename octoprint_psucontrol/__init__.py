@@ -5,45 +5,115 @@ __author__ = "Shawn Bruce <kantlivelong@gmail.com>"
 __license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
 __copyright__ = "Copyright (C) 2017 Shawn Bruce - Released under terms of the AGPLv3 License"
 
+import time
+_IMPORT_STARTED = time.monotonic()
+
 import octoprint.plugin
 from octoprint.events import Events
-import time
-import subprocess
+import collections
+import datetime
+import functools
+import hashlib
+import itertools
+import os
+import queue
+import select
 import threading
 import glob
+import concurrent.futures
 from flask import make_response, jsonify
+from flask_login import current_user
 from flask_babel import gettext
 import platform
-from octoprint.util import fqfn
 from octoprint.settings import valid_boolean_trues
 import flask
 from . import cli
+from .executor import Executor
 
-try:
-    import periphery
-    HAS_GPIO = True
-except ModuleNotFoundError:
-    HAS_GPIO = False
 
-try:
-    KERNEL_VERSION = tuple([int(s) for s in platform.release().split(".")[:2]])
-except ValueError:
-    KERNEL_VERSION = (0, 0)
+# GPIO support and kernel capabilities are probed on first use rather than at
+# import so hosts that never use GPIO don't pay for them during startup.
+
+@functools.lru_cache(maxsize=None)
+def _load_gpio():
+    try:
+        from . import gpio
+    except ImportError:
+        return None
+
+    return gpio
+
+
+def has_gpio():
+    return _load_gpio() is not None
+
+
+@functools.lru_cache(maxsize=None)
+def get_kernel_version():
+    try:
+        return tuple([int(s) for s in platform.release().split(".")[:2]])
+    except ValueError:
+        return (0, 0)
+
+
+def supports_line_bias():
+    return get_kernel_version() >= (5, 5)
+
+PRIMARY_CHANNEL = 'psu'
+
+# Key of the line request holding a chip's sense lines, outputs are keyed by their pin.
+_GPIO_SENSE_REQUEST = 'sense'
 
-SUPPORTS_LINE_BIAS = KERNEL_VERSION >= (5, 5)
+# Settings that affect how or how often the state is sensed.
+_SENSING_FIELDS = frozenset(['channels', 'GPIODevice', 'sensingMethod', 'senseGPIOPin', 'invertsenseGPIOPin', 'senseGPIOPinPUD',
+                             'senseGPIOPinEdgeDetection', 'senseSystemCommand', 'senseSystemCommandPersistent', 'sensingPlugin',
+                             'sensePollingInterval', 'sensePollingMaxInterval', 'sensePollingFastInterval', 'sensePollingFastWindow',
+                             'senseGPIOFilter', 'senseGPIOFilterSamples', 'senseGPIOFilterThreshold', 'senseGPIOFilterStableTime',
+                             'senseGPIOFilterSampleInterval'])
+
+POWER_STATE_OFF = 'OFF'
+POWER_STATE_SWITCHING_ON = 'SWITCHING_ON'
+POWER_STATE_SWITCHING_OFF = 'SWITCHING_OFF'
+POWER_STATE_SETTLING = 'SETTLING'
+POWER_STATE_ON = 'ON'
+
+# How often readiness conditions are checked while powering on.
+READY_CHECK_INTERVAL = 0.1
+
+# Limits of the batch API command. A request waiting on a batch gives up after
+# BATCH_WAIT_TIMEOUT and gets the batch id to look the results up later. Waiting
+# on a single switch is bounded by BATCH_WAIT_TIMEOUT as well.
+BATCH_MAX_DELAY = 300.0
+BATCH_MAX_TOTAL_DELAY = 900.0
+BATCH_WAIT_TIMEOUT = 30.0
+BATCH_KEEP = 32
 
 try:
     from octoprint.access.permissions import Permissions
 except Exception:
     from octoprint.server import user_permission
 
-try:
-    from octoprint.util import ResettableTimer
-except Exception:
-    from .util import ResettableTimer
+from octoprint.printer import PrinterCallback
+from .util import CoolingEstimator, Scheduler, SwitchOperation
+from .connect import AutoConnect
+from .stream import StateBroadcaster, StateStreamHandler
+from .metrics import Registry, HOOK_BUCKETS, SWITCH_BUCKETS
+from . import history
+from .subplugin import SubPluginRegistration
+from .config import compile_config, changed_fields
+from .debounce import SenseFilter, FILTER_MAJORITY, FILTER_STABLE
+
+
+class _HeaterCallback(PrinterCallback):
+    def __init__(self, plugin):
+        self._plugin = plugin
+
+    def on_printer_add_temperature(self, data):
+        self._plugin._on_printer_add_temperature(data)
 
 
 class PSUControl(octoprint.plugin.StartupPlugin,
+                 octoprint.plugin.ShutdownPlugin,
                  octoprint.plugin.TemplatePlugin,
                  octoprint.plugin.AssetPlugin,
                  octoprint.plugin.SettingsPlugin,
@@ -52,22 +122,93 @@ class PSUControl(octoprint.plugin.StartupPlugin,
                  octoprint.plugin.WizardPlugin):
 
     def __init__(self):
+        self._startupTimes = dict(import_=_IMPORT_DURATION)
+        started = time.monotonic()
+
         self._sub_plugins = dict()
-        self._availableGPIODevices = self.get_gpio_devs()
+        self._executor = None
+        self._availableGPIODevices = None
 
-        self.config = dict()
+        self.config = None
 
-        self._autoOnTriggerGCodeCommandsArray = []
-        self._idleIgnoreCommandsArray = []
+        self._gcode_queuing_handler = None
         self._check_psu_state_thread = None
         self._check_psu_state_event = threading.Event()
+        self._scheduler = None
+        self._autoConnect = None
         self._idleTimer = None
+        self._idleLock = threading.Lock()
+        self._idleGeneration = 0
+        self._idleLastActivity = 0
+        self._heaterCheckTimer = None
+        self._heaterLock = threading.RLock()
+        self._heaterCallback = _HeaterCallback(self)
+        self._heaterCallbackRegistered = False
+        self._heaterCallbackAttached = False
+        self._coolingEstimator = CoolingEstimator()
+        self._cooldownDeadline = None
+        self._pollTimer = None
+        self._pollInterval = None
+        self._pollExpected = dict()
+        self._pollFastUntil = 0
+        self._pollLock = threading.Lock()
         self._waitForHeaters = False
         self._skipIdleTimer = False
-        self._configuredGPIOPins = {}
-        self._noSensing_isPSUOn = False
+        self._gpioGroups = {}
+        self._gpioLayout = {}
+        self._gpioSwitchLines = {}
+        self._gpioSenseLines = {}
+        self._senseEdgeWatcher = None
+        self._senseEdgeLock = threading.Lock()
+        self._senseFilter = None
+        self._noSensingStates = dict()
+        self._channelStates = dict()
+        self._stateMessageLock = threading.Lock()
+        self._stateMessageSeq = 0
+        self._stateMessageLastSent = (False, POWER_STATE_OFF, None, ())
+        self._stateMessageTimer = None
+        self._stateHeartbeatTimer = None
+        self._stateBroadcaster = StateBroadcaster(self._get_state_message)
+        self._switchLock = threading.Lock()
+        self._switchQueue = queue.Queue()
+        self._switchThread = None
+        self._switchOperation = None
+        self._switchLatest = dict()
+        self._lastSwitchOperation = None
+        self._switchTarget = None
+        self._switchPrimaryPending = 0
+        self._powerState = POWER_STATE_OFF
         self.isPSUOn = False
 
+        self._uploadPrint = None
+        self._batches = collections.OrderedDict()
+        self._batchIds = itertools.count(1)
+        self._batchLock = threading.Lock()
+
+        self._history = history.PowerHistory()
+        self._historyStarted = False
+        self._historySaveTimer = None
+
+        self._metrics = Registry()
+        self._metricSwitchDuration = self._metrics.histogram('switch_duration_seconds', "Time from a switch request until it completed, including any post on delay.", ('channel', 'method', 'target'), SWITCH_BUCKETS)
+        self._metricSwitchActuation = self._metrics.histogram('switch_actuation_seconds', "Time spent driving the switching method.", ('channel', 'method'))
+        self._metricSwitches = self._metrics.counter('switches_total', "Completed switch requests.", ('channel', 'target', 'result'))
+        self._metricCoalesced = self._metrics.counter('switch_requests_coalesced_total', "Switch requests that joined a pending switch to the same state.", ('channel', 'target'))
+        self._metricSenseDuration = self._metrics.histogram('sense_duration_seconds', "Time spent sensing. GPIO reads all sense lines of a device at once, so its source is the device.", ('source', 'method'))
+        self._metricCheckCycle = self._metrics.histogram('check_cycle_duration_seconds', "Duration of a full state check cycle.").labels()
+        self._metricStateChanges = self._metrics.counter('state_changes_total', "Sensed on/off transitions.", ('channel',))
+        self._metricIdleResets = self._metrics.counter('idle_timer_resets_total', "Idle timer resets caused by queued G-code.").labels()
+        self._metricAutoOn = self._metrics.counter('auto_on_triggers_total', "Times queued G-code turned the PSU on.").labels()
+        self._metricHookLines = self._metrics.counter('gcode_hook_lines_total', "Lines handled by the G-code queuing hook while a feature using it is enabled.").labels()
+        self._metricHookDuration = self._metrics.histogram('gcode_hook_duration_seconds', "Time the G-code queuing hook spends per line, sampled every 64th line.", buckets=HOOK_BUCKETS).labels()
+        self._metricPollInterval = self._metrics.gauge('poll_interval_seconds', "Delay chosen for the next state poll. 0 while nothing needs polling.").labels()
+        self._metricPolls = self._metrics.counter('polls_scheduled_total', "State polls scheduled, by polling mode.", ('mode',))
+        self._metricReady = self._metrics.histogram('power_on_ready_seconds', "Time from switching the PSU on until a readiness condition was met.", ('condition',), SWITCH_BUCKETS)
+        self._metricReadyTimeouts = self._metrics.counter('power_on_ready_timeouts_total', "Power ons that gave up waiting on a readiness condition.", ('condition',))
+        self._metricGlitches = self._metrics.counter('sense_glitches_rejected_total', "GPIO sense readings rejected by the debounce filter.", ('channel',))
+
+        self._startupTimes['init'] = time.monotonic() - started
+
 
     def get_settings_defaults(self):
         return dict(
@@ -84,14 +225,28 @@ class PSUControl(octoprint.plugin.StartupPlugin,
             pseudoOnGCodeCommand = 'M80',
             pseudoOffGCodeCommand = 'M81',
             postOnDelay = 0.0,
+            postOnWaitForSense = False,
+            postOnWaitForPort = False,
+            postOnWaitForPrinter = False,
             connectOnPowerOn = False,
+            connectTimeout = 60.0,
             disconnectOnPowerOff = False,
             sensingMethod = 'INTERNAL',
             senseGPIOPin = 0,
             sensePollingInterval = 5,
+            sensePollingMaxInterval = 0,
+            sensePollingFastInterval = 0.2,
+            sensePollingFastWindow = 10.0,
+            senseGPIOFilter = '',
+            senseGPIOFilterSamples = 5,
+            senseGPIOFilterThreshold = 4,
+            senseGPIOFilterStableTime = 0.02,
+            senseGPIOFilterSampleInterval = 0.002,
             invertsenseGPIOPin = False,
             senseGPIOPinPUD = '',
+            senseGPIOPinEdgeDetection = True,
             senseSystemCommand = '',
+            senseSystemCommandPersistent = False,
             sensingPlugin = '',
             autoOn = False,
             autoOnTriggerGCodeCommands = "G0,G1,G2,G3,G10,G11,G28,G29,G32,M104,M106,M109,M140,M190",
@@ -101,11 +256,46 @@ class PSUControl(octoprint.plugin.StartupPlugin,
             idleIgnoreCommands = 'M105',
             idleTimeoutWaitTemp = 50,
             turnOnWhenApiUploadPrint = False,
-            turnOffWhenError = False
+            turnOffWhenError = False,
+            stateMessageCoalesceDelay = 0.25,
+            stateMessageHeartbeatInterval = 60,
+            sensingTimeout = 5.0,
+            switchingTimeout = 10.0,
+            switchingFailOnExitCode = False,
+            channels = []
+        )
+
+
+    def get_channel_defaults(self):
+        return dict(
+            name = '',
+            GPIODevice = '',
+            switchingMethod = 'GPIO',
+            onoffGPIOPin = 0,
+            invertonoffGPIOPin = False,
+            onGCodeCommand = '',
+            offGCodeCommand = '',
+            onSysCommand = '',
+            offSysCommand = '',
+            switchingPlugin = '',
+            sensingMethod = 'INTERNAL',
+            senseGPIOPin = 0,
+            invertsenseGPIOPin = False,
+            senseGPIOPinPUD = '',
+            senseGPIOPinEdgeDetection = True,
+            senseSystemCommand = '',
+            senseSystemCommandPersistent = False,
+            sensingPlugin = ''
         )
 
 
     def on_settings_initialized(self):
+        started = time.monotonic()
+
+        self._executor = Executor(self._logger)
+        self._scheduler = Scheduler(self._logger)
+        self._autoConnect = AutoConnect(self._printer, self._scheduler, self._logger, functools.partial(self._is_ready, 'port'))
+
         scripts = self._settings.listScripts("gcode")
 
         if not "psucontrol_post_on" in scripts:
@@ -116,8 +306,11 @@ class PSUControl(octoprint.plugin.StartupPlugin,
 
         self.reload_settings()
 
+        self._startupTimes['settings'] = time.monotonic() - started
+
 
     def reload_settings(self):
+        values = dict()
         for k, v in self.get_settings_defaults().items():
             if type(v) == str:
                 v = self._settings.get([k])
@@ -127,455 +320,1511 @@ class PSUControl(octoprint.plugin.StartupPlugin,
                 v = self._settings.get_float([k])
             elif type(v) == bool:
                 v = self._settings.get_boolean([k])
+            elif type(v) == list:
+                v = self._settings.get([k]) or []
 
-            self.config[k] = v
+            values[k] = v
             self._logger.debug("{}: {}".format(k, v))
 
-        if self.config['switchingMethod'] == 'GPIO' and not HAS_GPIO:
-            self._logger.error("Unable to use GPIO for switchingMethod.")
-            self.config['switchingMethod'] = ''
+        config = compile_config(values, self.get_channel_defaults(), PRIMARY_CHANNEL, self._logger, has_gpio)
 
-        if self.config['sensingMethod'] == 'GPIO' and not HAS_GPIO:
-            self._logger.error("Unable to use GPIO for sensingMethod.")
-            self.config['sensingMethod'] = ''
+        # Readers may be on other threads; they see either the old or the new snapshot, never a mix.
+        self.config = config
 
-        if self.config['enablePseudoOnOff'] and self.config['switchingMethod'] == 'GCODE':
-            self._logger.warning("Pseudo On/Off cannot be used in conjunction with GCODE switching. Disabling.")
-            self.config['enablePseudoOnOff'] = False
+        self._channelStates = dict((name, self._channelStates.get(name, False)) for name in config.channels)
+        self._noSensingStates = dict((name, self._noSensingStates.get(name, False)) for name, _ in self._iter_channels())
 
-        self._autoOnTriggerGCodeCommandsArray = self.config['autoOnTriggerGCodeCommands'].split(',')
-        self._idleIgnoreCommandsArray = self.config['idleIgnoreCommands'].split(',')
+        self._gcode_queuing_handler = self._compile_gcode_queuing_handler()
+        self._pollInterval = None
+
+        if config.senseGPIOFilter in (FILTER_MAJORITY, FILTER_STABLE):
+            params = (config.senseGPIOFilter, config.senseGPIOFilterSamples, config.senseGPIOFilterThreshold,
+                      config.senseGPIOFilterStableTime, config.senseGPIOFilterSampleInterval)
+            if self._senseFilter is None or self._senseFilter.params != params:
+                self._senseFilter = SenseFilter(*params)
+        else:
+            self._senseFilter = None
+
+
+    def _iter_channels(self):
+        config = self.config
+        yield PRIMARY_CHANNEL, config
+        for name, channel in config.channels.items():
+            yield name, channel
+
+
+    def _channel_config(self, name):
+        config = self.config
+        if name == PRIMARY_CHANNEL:
+            return config
+
+        return config.channels.get(name)
+
+
+    def _channel_label(self, name):
+        return 'PSU' if name == PRIMARY_CHANNEL else name
+
+
+    def _executor_key(self, name, action):
+        return action if name == PRIMARY_CHANNEL else "{} {}".format(name, action)
+
+
+    def _uses_gpio(self):
+        return any(c.usesGPIO for _, c in self._iter_channels())
 
 
     def on_after_startup(self):
-        if self.config['switchingMethod'] == 'GPIO' or self.config['sensingMethod'] == 'GPIO':
+        started = time.monotonic()
+
+        if self._uses_gpio():
             self.configure_gpio()
 
+        self._load_history()
+
         self._check_psu_state_thread = threading.Thread(target=self._check_psu_state)
         self._check_psu_state_thread.daemon = True
         self._check_psu_state_thread.start()
 
         self._start_idle_timer()
+        self._start_state_heartbeat()
+
+        self._startupTimes['after_startup'] = time.monotonic() - started
+        self._logger.info("Startup took {:.1f}ms (import {:.1f}ms, init {:.1f}ms, settings {:.1f}ms, after startup {:.1f}ms), GPIO {}".format(
+            sum(self._startupTimes.values()) * 1000,
+            self._startupTimes.get('import_', 0) * 1000,
+            self._startupTimes.get('init', 0) * 1000,
+            self._startupTimes.get('settings', 0) * 1000,
+            self._startupTimes['after_startup'] * 1000,
+            self._get_gpio_load_state()))
+
+
+    def _get_gpio_load_state(self):
+        # Only looks at a cached result, asking _load_gpio() before it ran would load GPIO.
+        if not _load_gpio.cache_info().currsize:
+            return 'not loaded'
+
+        return 'loaded' if _load_gpio() is not None else 'unavailable'
+
+
+    def on_shutdown(self):
+        self._executor.stop_persistent()
+
+        self._history.append(None, history.CAUSE_SHUTDOWN)
+        self._save_history()
+
+
+    def _get_history_path(self):
+        return os.path.join(self.get_plugin_data_folder(), 'history.bin')
+
+
+    def _load_history(self):
+        path = self._get_history_path()
+        if not os.path.exists(path):
+            return
+
+        try:
+            self._history.load(path)
+        except Exception:
+            self._logger.exception("Unable to load power history from {}".format(path))
+
+
+    def _save_history(self):
+        self._historySaveTimer = None
+
+        if not self._history.dirty:
+            return
+
+        try:
+            self._history.save(self._get_history_path())
+        except Exception:
+            self._logger.exception("Unable to save power history")
+
+
+    def _record_history(self, state, cause, latency=None):
+        self._history.append(state, cause, latency)
+
+        # Transitions are rare, still batch the writes so a flapping PSU doesn't hammer the SD card.
+        if self._historySaveTimer is None and self._scheduler is not None:
+            self._historySaveTimer = self._scheduler.schedule(30, self._save_history)
+
+
+    def _attribute_transition(self):
+        # The switch that caused the state just sensed, if any. Sensing can lag behind
+        # the switch completing so the last finished one is considered as well.
+        for op in (self._switchOperation, self._lastSwitchOperation):
+            if (op is not None and op.channel == PRIMARY_CHANNEL and op.target == self.isPSUOn and
+                    time.monotonic() - op.created < 60):
+                self._lastSwitchOperation = None
+                return (op.cause or history.CAUSE_UNKNOWN), time.monotonic() - op.created
+
+        return history.CAUSE_EXTERNAL, None
+
+
+    def get_gpio_devs(self):
+        return sorted(glob.glob('/dev/gpiochip*'))
+
+
+    def _get_available_gpio_devices(self):
+        if self._availableGPIODevices is None:
+            self._availableGPIODevices = self.get_gpio_devs()
+
+        return self._availableGPIODevices
+
+
+    def cleanup_gpio(self, keys=None):
+        self._stop_sense_edge_watcher()
+
+        if keys is None:
+            keys = list(self._gpioGroups.keys())
+
+        # The sensing thread iterates these, so they are replaced rather than changed in place.
+        groups = [self._gpioGroups[key] for key in keys if key in self._gpioGroups]
+        self._gpioGroups = dict((key, group) for key, group in self._gpioGroups.items() if key not in keys)
+        self._gpioLayout = dict((key, lines) for key, lines in self._gpioLayout.items() if key not in keys)
+        self._gpioSwitchLines = dict((name, line) for name, line in self._gpioSwitchLines.items() if line[0] not in groups)
+        self._gpioSenseLines = dict((name, line) for name, line in self._gpioSenseLines.items() if line[0] not in groups)
+
+        for group in groups:
+            self._logger.debug("Cleaning up GPIO lines on {}".format(group.path))
+            try:
+                group.close()
+            except Exception:
+                self._logger.exception(
+                    "Exception while cleaning up GPIO lines on {}.".format(group.path)
+                )
+
+
+    def _get_gpio_bias(self, pud):
+        if not supports_line_bias():
+            if pud != '':
+                self._logger.warning("Kernel version 5.5 or greater required for GPIO bias. Using 'default'.")
+            return "default"
+        elif pud == '':
+            return "disable"
+        elif pud == 'PULL_UP':
+            return "pull_up"
+        elif pud == 'PULL_DOWN':
+            return "pull_down"
+        else:
+            return "default"
+
+
+    def _get_gpio_layout(self):
+        # line request key -> the lines channels want in it. Used to tell which requests need reopening.
+        # Every output has a request of its own, keyed by (device, pin), while the sense lines of a chip
+        # share one keyed by (device, _GPIO_SENSE_REQUEST). Changing a sense line then never releases
+        # a switch output, which the kernel would hand back as an input and so flip the relay.
+        layout = dict()
+        for name, channel in self._iter_channels():
+            if channel.switchingMethod == 'GPIO':
+                layout.setdefault((channel.GPIODevice, channel.onoffGPIOPin), []).append(('output', name, channel.onoffGPIOPin, channel.invertonoffGPIOPin))
+
+            if channel.sensingMethod == 'GPIO':
+                layout.setdefault((channel.GPIODevice, _GPIO_SENSE_REQUEST), []).append(('input', name, channel.senseGPIOPin, channel.senseGPIOPinPUD, channel.senseGPIOPinEdgeDetection))
+
+        return dict((device, tuple(lines)) for device, lines in layout.items())
+
+
+    def configure_gpio(self, keys=None, states=None):
+        # states maps channel names to the on/off state their output has to start in, off by default.
+        self._stop_sense_edge_watcher()
+
+        if states is None:
+            states = dict()
+
+        layout = self._get_gpio_layout()
+        if keys is None:
+            keys = list(layout.keys())
+        keys = [key for key in keys if key in layout]
+
+        if keys:
+            gpio = _load_gpio()
+            self._logger.info("Periphery version: {}".format(gpio.periphery.version))
+
+        groups = dict(self._gpioGroups)
+        gpio_layout = dict(self._gpioLayout)
+        all_switch_lines = dict(self._gpioSwitchLines)
+        all_sense_lines = dict(self._gpioSenseLines)
+
+        # Sense lines on the same chip share one request so a single ioctl reads all of them.
+        for key in keys:
+            device = key[0]
+            group = gpio.GPIOLineGroup(device)
+            switch_lines = dict()
+            sense_lines = dict()
+
+            for line in layout[key]:
+                name = line[1]
+                label = self._channel_label(name)
 
+                if line[0] == 'output':
+                    _, _, pin, invert = line
+                    self._logger.info("Using GPIO for {} On/Off".format(label))
+                    self._logger.info("Configuring GPIO for pin {}".format(pin))
+
+                    try:
+                        group.add_output(pin, initial=states.get(name, False) != invert)
+                        switch_lines[name] = (group, pin)
+                    except ValueError as e:
+                        self._logger.error("Unable to use GPIO pin {} for {}: {}".format(pin, label, e))
+                else:
+                    _, _, pin, pud, edge = line
+                    self._logger.info("Using GPIO sensing to determine {} on/off state.".format(label))
+                    self._logger.info("Configuring GPIO for pin {}".format(pin))
+
+                    try:
+                        group.add_input(pin, bias=self._get_gpio_bias(pud), edge=edge)
+                        sense_lines[name] = (group, pin)
+                    except ValueError as e:
+                        self._logger.error("Unable to use GPIO pin {} for {}: {}".format(pin, label, e))
+
+            try:
+                group.open()
+            except Exception:
+                self._logger.exception(
+                    "Exception while setting up GPIO lines on {}".format(device)
+                )
+                continue
+
+            groups[key] = group
+            gpio_layout[key] = layout[key]
+            all_switch_lines.update(switch_lines)
+            all_sense_lines.update(sense_lines)
+
+            for line in layout[key]:
+                if line[0] == 'input' and line[4] and line[1] in sense_lines and not group.has_edge(line[2]):
+                    self._logger.warning(
+                        "Edge detection is not available for GPIO pin {}. Falling back to polling.".format(line[2])
+                    )
+
+        # Swapped in whole so the sensing thread never sees them half updated.
+        self._gpioGroups = groups
+        self._gpioLayout = gpio_layout
+        self._gpioSwitchLines = all_switch_lines
+        self._gpioSenseLines = all_sense_lines
+
+        edge_groups = [group for group in groups.values() if group.fds]
+        if edge_groups:
+            self._start_sense_edge_watcher(edge_groups)
+
+
+    def _reconfigure_gpio(self):
+        layout = self._get_gpio_layout()
+        keys = [key for key in set(layout.keys()) | set(self._gpioLayout.keys())
+                if layout.get(key) != self._gpioLayout.get(key)]
+
+        if not keys:
+            self._logger.debug("GPIO configuration unchanged")
+            return
+
+        # Only requests whose own lines changed are reopened. An output that is, e.g. only
+        # inverted or moved to another channel keeps the state it was in.
+        states = dict()
+        for key in keys:
+            group = self._gpioGroups.get(key)
+            if group is None:
+                continue
+
+            for line in self._gpioLayout.get(key, ()):
+                if line[0] == 'output':
+                    _, name, pin, invert = line
+                    states[name] = group.output_level(pin) != invert
+
+        self._logger.info("Reconfiguring GPIO lines on {}".format(', '.join(sorted(set(key[0] for key in keys)))))
+        self.cleanup_gpio(keys)
+        self.configure_gpio(keys, states)
+
+
+    def _start_sense_edge_watcher(self, groups):
+        pins = [pin for group, pin in self._gpioSenseLines.values() if group.has_edge(pin)]
+        self._logger.info("Using edge detection on GPIO pin(s) {}".format(', '.join(str(pin) for pin in pins)))
+
+        stop_r, stop_w = os.pipe()
+        thread = threading.Thread(target=self._watch_sense_edges, args=(groups, stop_r))
+        thread.daemon = True
+        with self._senseEdgeLock:
+            self._senseEdgeWatcher = (thread, stop_w)
+        thread.start()
+
+
+    def _take_sense_edge_watcher(self, thread=None):
+        # Whoever takes the watcher out owns its stop pipe and is the only one to close it.
+        with self._senseEdgeLock:
+            watcher = self._senseEdgeWatcher
+            if watcher is None or (thread is not None and watcher[0] is not thread):
+                return None
+
+            self._senseEdgeWatcher = None
+            return watcher
+
+
+    def _stop_sense_edge_watcher(self):
+        watcher = self._take_sense_edge_watcher()
+        if watcher is None:
+            return
+
+        thread, stop_w = watcher
+        try:
+            os.write(stop_w, b'x')
+        except OSError:
+            # The watcher already gave up and closed its end.
+            pass
+        thread.join(1.0)
+        os.close(stop_w)
+
+
+    def _watch_sense_edges(self, groups, stop_r):
+        poller = select.poll()
+        fd_groups = dict()
+        for group in groups:
+            for fd in group.fds:
+                fd_groups[fd] = group
+                poller.register(fd, select.POLLIN | select.POLLPRI)
+        poller.register(stop_r, select.POLLIN)
+
+        try:
+            while True:
+                events = dict(poller.poll())
+
+                if stop_r in events:
+                    return
+
+                for fd, mask in events.items():
+                    if mask & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                        raise IOError("Error condition on GPIO line")
+
+                # Drain every queued edge so a burst results in a single read.
+                for group in set(fd_groups[fd] for fd in events):
+                    group.read_events()
+
+                self.check_psu_state()
+        except Exception:
+            self._logger.exception("Exception while waiting for GPIO edge events. Falling back to polling.")
+            # Leaves a newer watcher started by configure_gpio alone.
+            watcher = self._take_sense_edge_watcher(threading.current_thread())
+            if watcher is not None:
+                os.close(watcher[1])
+            self.check_psu_state()
+        finally:
+            os.close(stop_r)
+
+
+    def _get_plugin_key(self, implementation):
+        for k, v in self._plugin_manager.plugin_implementations.items():
+            if v == implementation:
+                return k
+
+
+    def register_plugin(self, implementation):
+        k = self._get_plugin_key(implementation)
+
+        self._logger.debug("Registering plugin - {}".format(k))
+
+        if k is None:
+            self._logger.error("Unable to register plugin {}, it is not a loaded plugin implementation.".format(implementation))
+            return
+
+        if k not in self._sub_plugins:
+            self._logger.info("Registered plugin - {}".format(k))
+            self._sub_plugins[k] = SubPluginRegistration(k, implementation)
+
+        return self._sub_plugins[k]
+
+
+    def register_plugin_v2(self, implementation, push=False):
+        # OctoPrint sets _identifier on every plugin implementation, so there is no need to search for it.
+        k = getattr(implementation, '_identifier', None) or self._get_plugin_key(implementation)
+
+        self._logger.debug("Registering plugin (v2) - {}".format(k))
+
+        if k is None:
+            self._logger.error("Unable to register plugin {}, it is not a loaded plugin implementation.".format(implementation))
+            return
+
+        registration = SubPluginRegistration(k, implementation, push=push, on_notify=self._on_sub_plugin_notify)
+        self._sub_plugins[k] = registration
+
+        self._logger.info("Registered plugin - {}, callbacks={}, push={}".format(
+            k, [c for c in SubPluginRegistration.CALLBACKS if getattr(registration, c) is not None], push))
+
+        return registration
+
+
+    def _on_sub_plugin_notify(self, registration):
+        self._logger.debug("Plugin {} reported state {}".format(registration.identifier, registration.state))
+
+        for name, channel in self._iter_channels():
+            if channel.sensingMethod == 'PLUGIN' and channel.sensingPlugin == registration.identifier:
+                self.check_psu_state()
+                return
+
+
+    def check_psu_state(self):
+        self._check_psu_state_event.set()
+
+
+    def _check_psu_state(self):
+        while True:
+            # Anything escaping here would end sensing until OctoPrint is restarted.
+            try:
+                changed = self._update_psu_state()
+            except Exception:
+                self._logger.exception("Exception while checking the PSU state")
+                changed = False
+
+            try:
+                self._schedule_poll(changed)
+            except Exception:
+                self._logger.exception("Exception while scheduling the next PSU state check")
+
+            self._check_psu_state_event.wait()
+            self._check_psu_state_event.clear()
+
+
+    def _update_psu_state(self):
+        start = time.monotonic()
+        config = self.config
+        old_isPSUOn = self.isPSUOn
+
+        self._logger.debug("Polling PSU state...")
+
+        levels = self._read_gpio_levels()
+
+        self.isPSUOn = self._sense_channel(PRIMARY_CHANNEL, config, self.isPSUOn, levels)
+
+        self._logger.debug("isPSUOn: {}".format(self.isPSUOn))
+
+        if (old_isPSUOn != self.isPSUOn):
+            self._logger.debug("PSU state changed, firing psu_state_changed event.")
+            self._metricStateChanges.labels(PRIMARY_CHANNEL).inc()
+
+            event = Events.PLUGIN_PSUCONTROL_PSU_STATE_CHANGED
+            self._event_bus.fire(event, payload=dict(isPSUOn=self.isPSUOn))
+
+            event = Events.PLUGIN_PSUCONTROL_CHANNEL_STATE_CHANGED
+            self._event_bus.fire(event, payload=dict(channel=PRIMARY_CHANNEL, isOn=self.isPSUOn))
+
+        if not self._historyStarted:
+            self._historyStarted = True
+            self._record_history(self.isPSUOn, history.CAUSE_STARTUP)
+        elif old_isPSUOn != self.isPSUOn:
+            cause, latency = self._attribute_transition()
+            self._record_history(self.isPSUOn, cause, latency)
+
+        if (old_isPSUOn != self.isPSUOn) and self.isPSUOn:
+            self._start_idle_timer()
+        elif (old_isPSUOn != self.isPSUOn) and not self.isPSUOn:
+            self._stop_idle_timer()
+
+        op = self._switchOperation
+        if op is None or op.channel != PRIMARY_CHANNEL:
+            self._set_power_state(POWER_STATE_ON if self.isPSUOn else POWER_STATE_OFF)
+
+        channels_changed = False
+        for name, channel in config.channels.items():
+            old_state = self._channelStates.get(name, False)
+            new_state = self._sense_channel(name, channel, old_state, levels)
+            self._channelStates[name] = new_state
+
+            if old_state != new_state:
+                self._logger.debug("Channel {} state changed, firing channel_state_changed event.".format(name))
+                self._metricStateChanges.labels(name).inc()
+
+                event = Events.PLUGIN_PSUCONTROL_CHANNEL_STATE_CHANGED
+                self._event_bus.fire(event, payload=dict(channel=name, isOn=new_state))
+                channels_changed = True
+
+        changed = old_isPSUOn != self.isPSUOn or channels_changed
+        if changed:
+            self._queue_state_message()
+
+        self._metricCheckCycle.observe(time.monotonic() - start)
+
+        return changed
+
+
+    def _read_gpio_levels(self):
+        sense_filter = self._senseFilter
+        if sense_filter is None:
+            return self._read_gpio_groups()
+
+        def read():
+            samples = dict()
+            for device, lines in self._read_gpio_groups().items():
+                for pin, level in lines.items():
+                    samples[(device, pin)] = level
+            return samples
+
+        levels = dict()
+        for (device, pin), level in sense_filter.filter(read).items():
+            levels.setdefault(device, dict())[pin] = level
+
+        if sense_filter.glitches:
+            names = dict(((group.path, pin), name) for name, (group, pin) in self._gpioSenseLines.items())
+            for key in sense_filter.glitches:
+                name = names.get(key)
+                if name is not None:
+                    self._logger.debug("Rejected glitch on GPIO pin {} for {}".format(key[1], self._channel_label(name)))
+                    self._metricGlitches.labels(name).inc()
+
+        return levels
+
+
+    def _read_gpio_groups(self):
+        levels = dict()
+        for group in self._gpioGroups.values():
+            if not group.has_inputs:
+                continue
+
+            start = time.monotonic()
+            try:
+                levels[group.path] = group.read()
+                self._metricSenseDuration.labels(group.path, 'GPIO').observe(time.monotonic() - start)
+            except Exception:
+                self._logger.exception("Exception while reading GPIO lines on {}".format(group.path))
+
+        return levels
+
+
+    def _sense_channel(self, name, channel, current, levels):
+        if channel.sensingMethod == 'GPIO':
+            r = 0
+            line = self._gpioSenseLines.get(name)
+            if line is not None:
+                group, pin = line
+                r = levels.get(group.path, {}).get(pin, 0)
+
+            self._logger.debug("Result: {}".format(r))
+
+            return bool(r ^ channel.invertsenseGPIOPin)
+        elif channel.sensingMethod == 'SYSTEM':
+            key = self._executor_key(name, 'Sensing')
+
+            if channel.senseSystemCommandPersistent:
+                r = self._executor.run_persistent(key, channel.senseSystemCommand, self.config.sensingTimeout)
+                if r.ok:
+                    r.returncode = 0 if r.value else 1
+            else:
+                r = self._executor.run_command(key, channel.senseSystemCommand, self.config.sensingTimeout)
+
+            self._metricSenseDuration.labels(name, 'SYSTEM').observe(r.duration)
+
+            if r.timed_out:
+                # Keep the last known state rather than reporting a false off.
+                return current
+            elif r.returncode == 0:
+                return True
+
+            return False
+        elif channel.sensingMethod == 'INTERNAL':
+            return self._noSensingStates.get(name, False)
+        elif channel.sensingMethod == 'PLUGIN':
+            p = channel.sensingPlugin
+            plugin = self._sub_plugins.get(p)
+
+            r = False
+
+            if plugin is None:
+                self._logger.error('Plugin {} is configured for sensing but it is not registered.'.format(p))
+            elif plugin.push and plugin.state is not None:
+                r = plugin.state
+            elif plugin.get_psu_state is None:
+                if not plugin.push:
+                    self._logger.error('Plugin {} is configured for sensing but get_psu_state is not defined.'.format(p))
+            else:
+                result = self._executor.run_callback(self._executor_key(name, 'Sensing'), plugin.get_psu_state, self.config.sensingTimeout)
+                if not result.busy:
+                    self._metricSenseDuration.labels(name, 'PLUGIN').observe(result.duration)
+
+                if result.timed_out or result.busy:
+                    r = current
+                elif result.ok:
+                    r = result.value
+
+            return r
+        else:
+            return False
+
+
+    def _needs_polling(self):
+        sense_filter = self._senseFilter
+        if sense_filter is not None and not sense_filter.settled:
+            # The last burst was undecided, look again rather than waiting for the next edge.
+            return True
+
+        for name, channel in self._iter_channels():
+            if channel.sensingMethod == 'GPIO':
+                line = self._gpioSenseLines.get(name)
+                if self._senseEdgeWatcher is None or line is None or not line[0].has_edge(line[1]):
+                    return True
+            elif channel.sensingMethod == 'PLUGIN':
+                # Plugins that push their state only need polling until the first report.
+                plugin = self._sub_plugins.get(channel.sensingPlugin)
+                if plugin is None or not plugin.push or plugin.state is None:
+                    return True
+            else:
+                return True
+
+        return False
+
+
+    def _schedule_poll(self, changed=False):
+        if self._pollTimer is not None:
+            self._pollTimer.cancel()
+            self._pollTimer = None
+
+        if not self._needs_polling():
+            # Edge events wake us up; nothing to poll while the lines are stable.
+            self._pollInterval = None
+            self._metricPollInterval.set(0)
+            return
+
+        interval, mode = self._next_poll_interval(changed)
+        self._metricPollInterval.set(interval)
+        self._metricPolls.labels(mode).inc()
+
+        self._pollTimer = self._scheduler.schedule(interval, self.check_psu_state)
+
+
+    def _next_poll_interval(self, changed):
+        base = self.config.sensePollingInterval
+
+        with self._pollLock:
+            if self._pollExpected:
+                for name, on in list(self._pollExpected.items()):
+                    if self.get_channel_state(name) == on:
+                        del self._pollExpected[name]
+
+                if self._pollExpected and time.monotonic() < self._pollFastUntil:
+                    return min(self.config.sensePollingFastInterval, base), 'fast'
+
+                if self._pollExpected:
+                    self._logger.debug("Expected state not sensed within the fast polling window: {}".format(self._pollExpected))
+                    self._pollExpected = dict()
+
+                # Start backing off from the normal interval again once the switch is confirmed.
+                changed = True
+
+        if changed or self._pollInterval is None:
+            self._pollInterval = base
+            return base, 'normal'
+
+        # Nothing changed since the last poll, back off towards the maximum interval. With
+        # the maximum at or below the base interval, the default, there is no back off.
+        self._pollInterval = min(self._pollInterval * 2, max(self.config.sensePollingMaxInterval, base))
+        return self._pollInterval, 'backoff' if self._pollInterval > base else 'normal'
+
+
+    def _expect_state(self, name, on):
+        if self.config.sensePollingFastWindow <= 0:
+            return
+
+        with self._pollLock:
+            self._pollExpected[name] = on
+            self._pollFastUntil = time.monotonic() + self.config.sensePollingFastWindow
+
+        self.check_psu_state()
+
+
+    def _get_state_message(self, channel=None):
+        if channel is not None:
+            return dict(channel=channel,
+                        isPSUOn=self._channelStates.get(channel, False),
+                        seq=self._stateMessageSeq)
+
+        return dict(isPSUOn=self.isPSUOn,
+                    state=self._powerState,
+                    cooldownEta=self.get_cooldown_eta(),
+                    channels=dict(self._channelStates),
+                    seq=self._stateMessageSeq)
+
+
+    def _get_state_key(self):
+        return (self.isPSUOn, self._powerState, self._cooldownDeadline, tuple(sorted(self._channelStates.items())))
+
+
+    def _queue_state_message(self):
+        delay = self.config.stateMessageCoalesceDelay
+        if delay <= 0:
+            self._send_state_message()
+            return
+
+        # Flaps within the delay are collapsed into a single message carrying the final state.
+        with self._stateMessageLock:
+            if self._stateMessageTimer is None:
+                self._stateMessageTimer = self._scheduler.schedule(delay, self._send_state_message)
+
+
+    def _send_state_message(self, heartbeat=False):
+        with self._stateMessageLock:
+            if not heartbeat:
+                self._stateMessageTimer = None
+
+                state = self._get_state_key()
+                if state == self._stateMessageLastSent:
+                    return
+
+                self._stateMessageSeq += 1
+                self._stateMessageLastSent = state
+
+            message = self._get_state_message()
+
+        self._plugin_manager.send_plugin_message(self._identifier, message)
+
+        if not heartbeat:
+            self._stateBroadcaster.publish()
+
+
+    def _start_state_heartbeat(self):
+        self._stop_state_heartbeat()
+
+        if self.config.stateMessageHeartbeatInterval > 0:
+            self._stateHeartbeatTimer = self._scheduler.schedule(self.config.stateMessageHeartbeatInterval, self._state_heartbeat)
+
+
+    def _state_heartbeat(self):
+        self._send_state_message(heartbeat=True)
+        self._stateHeartbeatTimer = self._scheduler.schedule(self.config.stateMessageHeartbeatInterval, self._state_heartbeat)
+
+
+    def _stop_state_heartbeat(self):
+        if self._stateHeartbeatTimer:
+            self._stateHeartbeatTimer.cancel()
+            self._stateHeartbeatTimer = None
+
+
+    def _start_idle_timer(self):
+        with self._idleLock:
+            self._cancel_idle_timer()
+
+            if self.config.powerOffWhenIdle and self.isPSUOn:
+                self._idleLastActivity = time.monotonic()
+                self._idleTimer = self._scheduler.schedule(self.config.idleTimeout * 60, self._check_idle, self._idleGeneration)
+
+
+    def _stop_idle_timer(self):
+        with self._idleLock:
+            self._cancel_idle_timer()
+
+
+    def _cancel_idle_timer(self):
+        # Must hold _idleLock. Bumping the generation makes a _check_idle that is
+        # already running on the scheduler thread drop out instead of re-arming.
+        self._idleGeneration += 1
+        if self._idleTimer:
+            self._idleTimer.cancel()
+            self._idleTimer = None
+
+
+    def _reset_idle_timer(self):
+        # Called for every queued line, so only record the activity. The deadline is
+        # checked lazily by _check_idle when the scheduled job comes due.
+        self._idleLastActivity = time.monotonic()
+        self._metricIdleResets.inc()
+
+        if self._idleTimer is None:
+            self._start_idle_timer()
+
+
+    def _check_idle(self, generation):
+        with self._idleLock:
+            if generation != self._idleGeneration:
+                return
+
+            remaining = self._idleLastActivity + self.config.idleTimeout * 60 - time.monotonic()
+            if remaining > 0:
+                self._idleTimer = self._scheduler.schedule(remaining, self._check_idle, generation)
+                return
+
+            self._idleTimer = None
+
+        self._idle_poweroff()
+
+
+    def _idle_poweroff(self):
+        if not self.config.powerOffWhenIdle:
+            return
+
+        if self._waitForHeaters:
+            return
+
+        if self._printer.is_printing() or self._printer.is_paused():
+            return
+
+        self._logger.info("Idle timeout reached after {} minute(s). Turning heaters off prior to shutting off PSU.".format(self.config.idleTimeout))
+        self._wait_for_heaters()
+
+
+    def _wait_for_heaters(self):
+        if self._heaterCheckTimer is not None:
+            self._heaterCheckTimer.cancel()
+
+        self._waitForHeaters = True
+        heaters = self._printer.get_current_temperatures()
+
+        for heater, entry in heaters.items():
+            target = entry.get("target")
+            if target is None:
+                # heater doesn't exist in fw
+                continue
+
+            try:
+                temp = float(target)
+            except ValueError:
+                # not a float for some reason, skip it
+                continue
+
+            if temp != 0:
+                self._logger.info("Turning off heater: {}".format(heater))
+                self._skipIdleTimer = True
+                self._printer.set_temperature(heater, 0)
+                self._skipIdleTimer = False
+            else:
+                self._logger.debug("Heater {} already off.".format(heater))
+
+        with self._heaterLock:
+            self._coolingEstimator.reset()
+            if not self._heaterCallbackRegistered:
+                # Might still be attached if its removal hasn't run yet.
+                if not self._heaterCallbackAttached:
+                    self._printer.register_callback(self._heaterCallback)
+                    self._heaterCallbackAttached = True
+                self._heaterCallbackRegistered = True
+
+        self._check_heaters()
+
+
+    def _on_printer_add_temperature(self, data):
+        self._check_heaters(data, log=False)
+
+
+    def _check_heaters(self, heaters=None, log=True):
+        with self._heaterLock:
+            if self._heaterCheckTimer is not None:
+                self._heaterCheckTimer.cancel()
+                self._heaterCheckTimer = None
+
+            if not self._waitForHeaters:
+                if self._finish_wait_for_heaters():
+                    self._logger.info("Aborted PSU shut down due to activity.")
+                return
+
+            if heaters is None:
+                heaters = self._printer.get_current_temperatures()
+
+            now = time.monotonic()
+            highest_temp = 0
+            heaters_above_waittemp = []
+            for heater, entry in heaters.items():
+                if not heater.startswith("tool"):
+                    continue
+
+                actual = entry.get("actual")
+                if actual is None:
+                    # heater doesn't exist in fw
+                    continue
+
+                try:
+                    temp = float(actual)
+                except ValueError:
+                    # not a float for some reason, skip it
+                    continue
+
+                self._logger.debug("Heater {} = {}C".format(heater, temp))
+                self._coolingEstimator.add(heater, now, temp)
+                if temp > self.config.idleTimeoutWaitTemp:
+                    heaters_above_waittemp.append(heater)
+
+                if temp > highest_temp:
+                    highest_temp = temp
+
+            if highest_temp <= self.config.idleTimeoutWaitTemp:
+                self._waitForHeaters = False
+                self._finish_wait_for_heaters()
+                self._logger.info("Heaters below temperature.")
+                self.turn_psu_off(cause=history.CAUSE_IDLE)
+                return
+
+            self._update_cooldown_eta(self._coolingEstimator.estimate(self.config.idleTimeoutWaitTemp))
+
+            if log:
+                self._logger.info("Waiting for heaters({}) before shutting off PSU...".format(', '.join(heaters_above_waittemp)))
+
+            # Temperature updates drive this, the scheduled check only covers a stalled stream.
+            self._heaterCheckTimer = self._scheduler.schedule(30, self._check_heaters)
+
+
+    def _finish_wait_for_heaters(self):
+        registered = self._heaterCallbackRegistered
+        if registered:
+            self._heaterCallbackRegistered = False
+            # Usually called from within the temperature callback, while OctoPrint iterates
+            # over its callbacks. Removing ours right away would make it skip the next one.
+            self._scheduler.schedule(0, self._detach_heater_callback)
+
+        self._update_cooldown_eta(None)
+        return registered
+
+
+    def _detach_heater_callback(self):
+        with self._heaterLock:
+            if self._heaterCallbackAttached and not self._heaterCallbackRegistered:
+                self._printer.unregister_callback(self._heaterCallback)
+                self._heaterCallbackAttached = False
+
+
+    def _update_cooldown_eta(self, eta):
+        if eta is None:
+            deadline = None
+        else:
+            deadline = time.monotonic() + eta
+
+        old = self._cooldownDeadline
+        if (old is None) != (deadline is None) or (deadline is not None and abs(deadline - old) > 5):
+            if eta is not None:
+                self._logger.debug("Estimated {:.0f}s until heaters are below {}C".format(eta, self.config.idleTimeoutWaitTemp))
+            self._cooldownDeadline = deadline
+            self._queue_state_message()
+
+
+    def get_cooldown_eta(self):
+        deadline = self._cooldownDeadline
+        if deadline is None:
+            return None
+
+        return max(0.0, deadline - time.monotonic())
+
+
+    def _compile_gcode_queuing_handler(self):
+        enablePseudoOnOff = self.config.enablePseudoOnOff
+        autoOn = self.config.autoOn
+        powerOffWhenIdle = self.config.powerOffWhenIdle
+
+        if not (enablePseudoOnOff or autoOn or powerOffWhenIdle):
+            return None
+
+        pseudoOnGCodeCommand = self.config.pseudoOnGCodeCommand
+        pseudoOffGCodeCommand = self.config.pseudoOffGCodeCommand
+        autoOnTriggerGCodeCommands = self.config.autoOnTriggerGCodeCommandSet
+        idleIgnoreCommands = self.config.idleIgnoreCommandSet
+
+        def handler(comm_instance, cmd, gcode):
+            skipQueuing = False
+
+            if not gcode:
+                gcode = cmd.split(' ', 1)[0]
+
+            if enablePseudoOnOff:
+                if gcode == pseudoOnGCodeCommand:
+                    self.turn_psu_on(cause=history.CAUSE_GCODE)
+                    comm_instance._log("PSUControl: ok")
+                    skipQueuing = True
+                elif gcode == pseudoOffGCodeCommand:
+                    self.turn_psu_off(cause=history.CAUSE_GCODE)
+                    comm_instance._log("PSUControl: ok")
+                    skipQueuing = True
+
+            if autoOn and not self.isPSUOn and self._switchTarget is not True and gcode in autoOnTriggerGCodeCommands:
+                self._logger.info("Auto-On - Turning PSU On (Triggered by {})".format(gcode))
+                self._metricAutoOn.inc()
+                self.turn_psu_on(cause=history.CAUSE_AUTO_ON)
+
+            if powerOffWhenIdle and self.isPSUOn and not self._skipIdleTimer:
+                if gcode not in idleIgnoreCommands:
+                    self._waitForHeaters = False
+                    self._reset_idle_timer()
+
+            if skipQueuing:
+                return (None,)
+
+        return handler
+
+
+    def hook_gcode_queuing(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+        handler = self._gcode_queuing_handler
+        if handler is not None:
+            lines = self._metricHookLines
+            lines.value += 1
+            if lines.value & 63:
+                return handler(comm_instance, cmd, gcode)
+
+            start = time.perf_counter()
+            result = handler(comm_instance, cmd, gcode)
+            self._metricHookDuration.observe(time.perf_counter() - start)
+            return result
+
+
+    def _set_power_state(self, state):
+        if state == self._powerState:
+            return
+
+        self._logger.debug("Power state: {} -> {}".format(self._powerState, state))
+        self._powerState = state
+        self._queue_state_message()
+
+
+    def _submit_switch(self, target, channel=PRIMARY_CHANNEL, cause=None):
+        if channel == PRIMARY_CHANNEL and not target and self._autoConnect is not None:
+            # A power on waiting for the printer holds the switching worker. Stop it now
+            # rather than once this request is dequeued, which would be after the connect timeout.
+            # Not under the lock, cancelling completes that power on.
+            self._autoConnect.cancel()
+
+        with self._switchLock:
+            # A request for the state the channel is already heading to shares that
+            # switch and its result. Anything else is queued behind it.
+            latest = self._switchLatest.get(channel)
+            if latest is not None and not latest.done and latest.target == target:
+                self._metricCoalesced.labels(channel, 'on' if target else 'off').inc()
+                return latest
+
+            op = SwitchOperation(target, channel, cause)
+            self._switchLatest[channel] = op
+
+            if self._switchThread is None:
+                self._switchThread = threading.Thread(target=self._switch_worker, name="PSUControl switching")
+                self._switchThread.daemon = True
+                self._switchThread.start()
+
+            if channel == PRIMARY_CHANNEL:
+                self._switchTarget = target
+                self._switchPrimaryPending += 1
+            self._switchQueue.put(op)
+
+        return op
+
+
+    def _switch_worker(self):
+        while True:
+            op = self._switchQueue.get()
+            self._switchOperation = op
+            primary = op.channel == PRIMARY_CHANNEL
+
+            delay = None
+            try:
+                if not primary:
+                    delay = self._turn_channel(op.channel, op.target)
+                elif op.target:
+                    delay = self._turn_psu_on()
+                else:
+                    delay = self._turn_psu_off()
+            except Exception:
+                self._logger.exception("Exception while switching {} {}".format(self._channel_label(op.channel), 'On' if op.target else 'Off'))
+
+            if delay is None:
+                self._finish_switch(op, False)
+            elif primary and op.target:
+                self._set_power_state(POWER_STATE_SETTLING)
+                self._await_power_on(op, delay)
+            elif primary:
+                self._set_power_state(POWER_STATE_SETTLING)
+                self._scheduler.schedule(delay, self._settle_psu_off, op)
+            else:
+                self._scheduler.schedule(delay, self._settle_channel, op)
+
+            # The scheduler completes the operation once the PSU has settled.
+            op.wait()
+
+
+    def _finish_switch(self, op, result):
+        primary = op.channel == PRIMARY_CHANNEL
+
+        with self._switchLock:
+            self._switchOperation = None
+            if primary:
+                self._lastSwitchOperation = op
+                self._switchPrimaryPending -= 1
+                if self._switchPrimaryPending == 0:
+                    self._switchTarget = None
+
+        channel = self._channel_config(op.channel)
+        target = 'on' if op.target else 'off'
+        self._metricSwitches.labels(op.channel, target, 'ok' if result else 'failed').inc()
+        if result and channel is not None:
+            self._metricSwitchDuration.labels(op.channel, channel.switchingMethod, target).observe(time.monotonic() - op.created)
+
+        if primary:
+            if result:
+                self._set_power_state(POWER_STATE_ON if op.target else POWER_STATE_OFF)
+            else:
+                self._set_power_state(POWER_STATE_ON if self.isPSUOn else POWER_STATE_OFF)
+
+        op.complete(result)
+
+
+    def _get_ready_conditions(self):
+        conditions = []
+
+        # Internal sensing reports on as soon as the switch was made, waiting on it is pointless.
+        if self.config.postOnWaitForSense and not self.config.internalSensing:
+            conditions.append('sense')
+
+        if self.config.postOnWaitForPort:
+            conditions.append('port')
+
+        return conditions
+
+
+    def _await_power_on(self, op, delay):
+        # With readiness conditions the post on delay is only an upper bound.
+        conditions = self._get_ready_conditions()
+        if not conditions:
+            self._scheduler.schedule(delay, self._settle_psu_on, op)
+            return
+
+        started = time.monotonic()
+        self._check_power_ready(op, conditions, started, started + delay)
+
+
+    def _check_power_ready(self, op, pending, started, deadline):
+        now = time.monotonic()
+
+        try:
+            for condition in list(pending):
+                if self._is_ready(condition):
+                    self._logger.debug("PSU ready ({}) after {:.2f}s".format(condition, now - started))
+                    self._metricReady.labels(condition).observe(now - started)
+                    pending.remove(condition)
+        except Exception:
+            self._logger.exception("Exception while checking PSU readiness")
+            pending = []
+
+        if not pending:
+            self._logger.info("PSU ready after {:.2f}s, post on delay is {}s".format(now - started, self.config.postOnDelay))
+            self._settle_psu_on(op, started)
+            return
+
+        if now >= deadline:
+            self._logger.warning("PSU not ready ({}) within the post on delay of {}s, continuing anyway".format(', '.join(pending), self.config.postOnDelay))
+            for condition in pending:
+                self._metricReadyTimeouts.labels(condition).inc()
+            self._settle_psu_on(op, started)
+            return
 
-    def get_gpio_devs(self):
-        return sorted(glob.glob('/dev/gpiochip*'))
+        if 'sense' in pending:
+            self.check_psu_state()
 
+        self._scheduler.schedule(min(READY_CHECK_INTERVAL, deadline - now), self._check_power_ready, op, pending, started, deadline)
 
-    def cleanup_gpio(self):
-        for k, pin in self._configuredGPIOPins.items():
-            self._logger.debug("Cleaning up {} pin {}".format(k, pin.name))
-            try:
-                pin.close()
-            except Exception:
-                self._logger.exception(
-                    "Exception while cleaning up {} pin {}.".format(k, pin.name)
-                )
-        self._configuredGPIOPins = {}
 
+    def _is_ready(self, condition):
+        if condition == 'sense':
+            return self.isPSUOn
+        elif condition == 'port':
+            options = self._printer.get_connection_options()
+            ports = options.get('ports') or []
+            preferred = options.get('portPreference')
+            if preferred and preferred != 'AUTO':
+                return preferred in ports
+            return len(ports) > 0
 
-    def configure_gpio(self):
-        self._logger.info("Periphery version: {}".format(periphery.version))
+        return True
 
-        if self.config['switchingMethod'] == 'GPIO':
-            self._logger.info("Using GPIO for On/Off")
-            self._logger.info("Configuring GPIO for pin {}".format(self.config['onoffGPIOPin']))
 
-            if not self.config['invertonoffGPIOPin']:
-                initial_output = 'low'
-            else:
-                initial_output = 'high'
+    def _settle_psu_on(self, op, started=None):
+        if started is None:
+            started = op.created
 
-            try:
-                pin = periphery.GPIO(self.config['GPIODevice'], self.config['onoffGPIOPin'], initial_output)
-                self._configuredGPIOPins['switch'] = pin
-            except Exception:
-                self._logger.exception(
-                    "Exception while setting up GPIO pin {}".format(self.config['onoffGPIOPin'])
-                )
+        try:
+            self.check_psu_state()
 
-        if self.config['sensingMethod'] == 'GPIO':
-            self._logger.info("Using GPIO sensing to determine PSU on/off state.")
-            self._logger.info("Configuring GPIO for pin {}".format(self.config['senseGPIOPin']))
-
-
-            if not SUPPORTS_LINE_BIAS:
-                if self.config['senseGPIOPinPUD'] != '':
-                    self._logger.warning("Kernel version 5.5 or greater required for GPIO bias. Using 'default'.")
-                bias = "default"
-            elif self.config['senseGPIOPinPUD'] == '':
-                bias = "disable"
-            elif self.config['senseGPIOPinPUD'] == 'PULL_UP':
-                bias = "pull_up"
-            elif self.config['senseGPIOPinPUD'] == 'PULL_DOWN':
-                bias = "pull_down"
-            else:
-                bias = "default"
+            if self.config.connectOnPowerOn and self._printer.is_closed_or_error():
+                wait = self.config.postOnWaitForPrinter
+
+                def connected(result, elapsed):
+                    # The post on script is held back until the printer is operational.
+                    if result:
+                        self._metricReady.labels('printer').observe(time.monotonic() - started)
+                        self._run_post_on_script()
+                    elif result is False:
+                        self._metricReadyTimeouts.labels('printer').inc()
+
+                    if wait:
+                        self._finish_switch(op, True)
+
+                self._autoConnect.start(self.config.connectTimeout, connected)
+                if not wait:
+                    self._finish_switch(op, True)
+                return
+        except Exception:
+            self._logger.exception("Exception while completing PSU On")
+            self._finish_switch(op, False)
+            return
 
-            try:
-                pin = periphery.CdevGPIO(path=self.config['GPIODevice'], line=self.config['senseGPIOPin'], direction='in', bias=bias)
-                self._configuredGPIOPins['sense'] = pin
-            except Exception:
-                self._logger.exception(
-                    "Exception while setting up GPIO pin {}".format(self.config['senseGPIOPin'])
-                )
+        self._run_post_on_script()
+        self._finish_switch(op, True)
 
 
-    def _get_plugin_key(self, implementation):
-        for k, v in self._plugin_manager.plugin_implementations.items():
-            if v == implementation:
-                return k
+    def _run_post_on_script(self):
+        try:
+            if self._printer.is_operational():
+                self._printer.script("psucontrol_post_on", must_be_set=False)
+        except Exception:
+            self._logger.exception("Exception while running psucontrol_post_on script")
 
 
-    def register_plugin(self, implementation):
-        k = self._get_plugin_key(implementation)
+    def _settle_psu_off(self, op):
+        self.check_psu_state()
+        self._finish_switch(op, True)
 
-        self._logger.debug("Registering plugin - {}".format(k))
 
-        if k not in self._sub_plugins:
-            self._logger.info("Registered plugin - {}".format(k))
-            self._sub_plugins[k] = implementation
+    def _settle_channel(self, op):
+        self.check_psu_state()
+        self._finish_switch(op, True)
 
 
-    def check_psu_state(self):
-        self._check_psu_state_event.set()
+    def turn_psu_on(self, cause=history.CAUSE_PLUGIN):
+        return self._submit_switch(True, cause=cause)
 
 
-    def _check_psu_state(self):
-        while True:
-            old_isPSUOn = self.isPSUOn
+    def turn_psu_off(self, cause=history.CAUSE_PLUGIN):
+        return self._submit_switch(False, cause=cause)
 
-            self._logger.debug("Polling PSU state...")
 
-            if self.config['sensingMethod'] == 'GPIO':
-                r = 0
-                try:
-                    r = self._configuredGPIOPins['sense'].read()
-                except Exception:
-                    self._logger.exception("Exception while reading GPIO line")
+    def turn_channel_on(self, channel, cause=history.CAUSE_PLUGIN):
+        if channel == PRIMARY_CHANNEL:
+            return self.turn_psu_on(cause)
 
-                self._logger.debug("Result: {}".format(r))
+        if channel not in self.config.channels:
+            raise ValueError("Unknown channel: {}".format(channel))
 
-                new_isPSUOn = r ^ self.config['invertsenseGPIOPin']
+        return self._submit_switch(True, channel, cause)
 
-                self.isPSUOn = new_isPSUOn
-            elif self.config['sensingMethod'] == 'SYSTEM':
-                new_isPSUOn = False
 
-                p = subprocess.Popen(self.config['senseSystemCommand'], shell=True)
-                self._logger.debug("Sensing system command executed. PID={}, Command={}".format(p.pid, self.config['senseSystemCommand']))
-                while p.poll() is None:
-                    time.sleep(0.1)
-                r = p.returncode
-                self._logger.debug("Sensing system command returned: {}".format(r))
+    def turn_channel_off(self, channel, cause=history.CAUSE_PLUGIN):
+        if channel == PRIMARY_CHANNEL:
+            return self.turn_psu_off(cause)
 
-                if r == 0:
-                    new_isPSUOn = True
-                elif r == 1:
-                    new_isPSUOn = False
+        if channel not in self.config.channels:
+            raise ValueError("Unknown channel: {}".format(channel))
 
-                self.isPSUOn = new_isPSUOn
-            elif self.config['sensingMethod'] == 'INTERNAL':
-                self.isPSUOn = self._noSensing_isPSUOn
-            elif self.config['sensingMethod'] == 'PLUGIN':
-                p = self.config['sensingPlugin']
+        return self._submit_switch(False, channel, cause)
 
-                r = False
 
-                if p not in self._sub_plugins:
-                    self._logger.error('Plugin {} is configured for sensing but it is not registered.'.format(p))
-                elif not hasattr(self._sub_plugins[p], 'get_psu_state'):
-                    self._logger.error('Plugin {} is configured for sensing but get_psu_state is not defined.'.format(p))
-                else:
-                    callback = self._sub_plugins[p].get_psu_state
-                    try:
-                        r = callback()
-                    except Exception:
-                        self._logger.exception(
-                            "Error while executing callback {}".format(
-                                callback
-                            ),
-                            extra={"callback": fqfn(callback)},
-                        )
-
-                self.isPSUOn = r
-            else:
-                self.isPSUOn = False
+    def get_channel_state(self, channel):
+        if channel == PRIMARY_CHANNEL:
+            return self.isPSUOn
 
-            self._logger.debug("isPSUOn: {}".format(self.isPSUOn))
+        return self._channelStates.get(channel)
 
-            if (old_isPSUOn != self.isPSUOn):
-                self._logger.debug("PSU state changed, firing psu_state_changed event.")
 
-                event = Events.PLUGIN_PSUCONTROL_PSU_STATE_CHANGED
-                self._event_bus.fire(event, payload=dict(isPSUOn=self.isPSUOn))
+    def get_channels(self):
+        return [name for name, _ in self._iter_channels()]
 
-            if (old_isPSUOn != self.isPSUOn) and self.isPSUOn:
-                self._start_idle_timer()
-            elif (old_isPSUOn != self.isPSUOn) and not self.isPSUOn:
-                self._stop_idle_timer()
 
-            self._plugin_manager.send_plugin_message(self._identifier, dict(isPSUOn=self.isPSUOn))
+    def get_power_state(self):
+        return self._powerState
 
-            self._check_psu_state_event.wait(self.config['sensePollingInterval'])
-            self._check_psu_state_event.clear()
 
+    def _switch_command(self, command, channel=None, cause=history.CAUSE_API):
+        if command == 'turnPSUOn':
+            target = True
+        elif command == 'turnPSUOff':
+            target = False
+        elif channel is not None:
+            target = not self._channelStates.get(channel, False)
+        else:
+            target = self._switchTarget
+            if target is None:
+                target = self.isPSUOn
+            target = not target
 
-    def _start_idle_timer(self):
-        self._stop_idle_timer()
+        if channel is not None:
+            return self.turn_channel_on(channel, cause) if target else self.turn_channel_off(channel, cause)
+        elif target:
+            return self.turn_psu_on(cause)
+        else:
+            return self.turn_psu_off(cause)
 
-        if self.config['powerOffWhenIdle'] and self.isPSUOn:
-            self._idleTimer = ResettableTimer(self.config['idleTimeout'] * 60, self._idle_poweroff)
-            self._idleTimer.start()
 
+    def run_batch(self, steps):
+        # Steps are (command, channel, delay). Each starts once the previous switch
+        # has finished and its delay has passed, chained through done callbacks
+        # and the scheduler so no thread is held while waiting.
+        batch = SwitchOperation(None)
+        pending = list(steps)
+        results = []
 
-    def _stop_idle_timer(self):
-        if self._idleTimer:
-            self._idleTimer.cancel()
-            self._idleTimer = None
+        def run_next(op=None):
+            if op is not None:
+                results.append(bool(op.result))
 
+            if not pending:
+                batch.complete(results)
+                return
 
-    def _reset_idle_timer(self):
-        try:
-            if self._idleTimer.is_alive():
-                self._idleTimer.reset()
+            command, channel, delay = pending.pop(0)
+            if delay > 0:
+                self._scheduler.schedule(delay, start, command, channel)
             else:
-                raise Exception()
-        except:
-            self._start_idle_timer()
+                start(command, channel)
 
+        def start(command, channel):
+            try:
+                op = self._switch_command(command, channel)
+            except Exception:
+                self._logger.exception("Exception while running batch step {}".format(command))
+                results.append(False)
+                pending[:] = []
+                batch.complete(results)
+                return
 
-    def _idle_poweroff(self):
-        if not self.config['powerOffWhenIdle']:
-            return
+            op.add_done_callback(run_next)
 
-        if self._waitForHeaters:
-            return
+        with self._batchLock:
+            batch.id = str(next(self._batchIds))
+            self._batches[batch.id] = batch
+            while len(self._batches) > BATCH_KEEP:
+                self._batches.popitem(last=False)
 
-        if self._printer.is_printing() or self._printer.is_paused():
-            return
+        run_next()
+        return batch
 
-        self._logger.info("Idle timeout reached after {} minute(s). Turning heaters off prior to shutting off PSU.".format(self.config['idleTimeout']))
-        if self._wait_for_heaters():
-            self._logger.info("Heaters below temperature.")
-            self.turn_psu_off()
-        else:
-            self._logger.info("Aborted PSU shut down due to activity.")
 
+    def _switch_channel(self, name, channel, on):
+        start = time.monotonic()
+        ok = self._actuate(name, channel, on)
+        self._metricSwitchActuation.labels(name, channel.switchingMethod).observe(time.monotonic() - start)
 
-    def _wait_for_heaters(self):
-        self._waitForHeaters = True
-        heaters = self._printer.get_current_temperatures()
+        if ok and channel.internalSensing:
+            self._noSensingStates[name] = on
 
-        for heater, entry in heaters.items():
-            target = entry.get("target")
-            if target is None:
-                # heater doesn't exist in fw
-                continue
+        if ok:
+            self._expect_state(name, on)
 
-            try:
-                temp = float(target)
-            except ValueError:
-                # not a float for some reason, skip it
-                continue
+        return ok
 
-            if temp != 0:
-                self._logger.info("Turning off heater: {}".format(heater))
-                self._skipIdleTimer = True
-                self._printer.set_temperature(heater, 0)
-                self._skipIdleTimer = False
-            else:
-                self._logger.debug("Heater {} already off.".format(heater))
 
-        while True:
-            if not self._waitForHeaters:
-                return False
+    def _actuate(self, name, channel, on):
+        label = self._channel_label(name)
+        action = 'On' if on else 'Off'
 
-            heaters = self._printer.get_current_temperatures()
+        if channel.switchingMethod == 'GCODE':
+            command = channel.onGCodeCommand if on else channel.offGCodeCommand
+            self._logger.debug("Switching {} {} Using GCODE: {}".format(label, action, command))
+            self._printer.commands(command)
+        elif channel.switchingMethod == 'SYSTEM':
+            command = channel.onSysCommand if on else channel.offSysCommand
+            self._logger.debug("Switching {} {} Using SYSTEM: {}".format(label, action, command))
 
-            highest_temp = 0
-            heaters_above_waittemp = []
-            for heater, entry in heaters.items():
-                if not heater.startswith("tool"):
-                    continue
+            result = self._executor.run_command(self._executor_key(name, action), command, self.config.switchingTimeout)
+            if not result.ok:
+                # A timeout or failure to start is already logged by the executor.
+                return False
+            elif result.returncode != 0:
+                # Plenty of switching scripts exit non-zero even though they switched, so
+                # this only fails the switch when asked to.
+                if self.config.switchingFailOnExitCode:
+                    self._logger.error("Switching {} {} failed, system command returned {}".format(label, action, result.returncode))
+                    return False
+
+                self._logger.warning("System command for switching {} {} returned {}".format(label, action, result.returncode))
+        elif channel.switchingMethod == 'GPIO':
+            self._logger.debug("Switching {} {} Using GPIO: {}".format(label, action, channel.onoffGPIOPin))
+            pin_output = channel.gpioOutputLevels[on]
 
-                actual = entry.get("actual")
-                if actual is None:
-                    # heater doesn't exist in fw
-                    continue
+            try:
+                group, pin = self._gpioSwitchLines[name]
+                group.write(pin, pin_output)
+            except Exception:
+                self._logger.exception("Exception while writing GPIO line")
+                return False
+        elif channel.switchingMethod == 'PLUGIN':
+            p = channel.switchingPlugin
+            self._logger.debug("Switching {} {} Using PLUGIN: {}".format(label, action, p))
 
-                try:
-                    temp = float(actual)
-                except ValueError:
-                    # not a float for some reason, skip it
-                    continue
+            plugin = self._sub_plugins.get(p)
+            if plugin is None:
+                self._logger.error('Plugin {} is configured for switching but it is not registered.'.format(p))
+                return False
 
-                self._logger.debug("Heater {} = {}C".format(heater, temp))
-                if temp > self.config['idleTimeoutWaitTemp']:
-                    heaters_above_waittemp.append(heater)
+            callback_async, callback = plugin.switch_callbacks(on)
+            if callback_async is not None:
+                return self._actuate_plugin_async(name, action, p, callback_async)
+            elif callback is None:
+                self._logger.error('Plugin {} is configured for switching but {} is not defined.'.format(p, 'turn_psu_on' if on else 'turn_psu_off'))
+                return False
 
-                if temp > highest_temp:
-                    highest_temp = temp
+            result = self._executor.run_callback(self._executor_key(name, action), callback, self.config.switchingTimeout)
+            if not result.ok:
+                return False
+        else:
+            return False
 
-            if highest_temp <= self.config['idleTimeoutWaitTemp']:
-                self._waitForHeaters = False
-                return True
+        return True
 
-            self._logger.info("Waiting for heaters({}) before shutting off PSU...".format(', '.join(heaters_above_waittemp)))
-            time.sleep(5)
 
+    def _actuate_plugin_async(self, name, action, p, callback):
+        timeout = self.config.switchingTimeout
 
-    def hook_gcode_queuing(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
-        skipQueuing = False
-
-        if not gcode:
-            gcode = cmd.split(' ', 1)[0]
-
-        if self.config['enablePseudoOnOff']:
-            if gcode == self.config['pseudoOnGCodeCommand']:
-                self.turn_psu_on()
-                comm_instance._log("PSUControl: ok")
-                skipQueuing = True
-            elif gcode == self.config['pseudoOffGCodeCommand']:
-                self.turn_psu_off()
-                comm_instance._log("PSUControl: ok")
-                skipQueuing = True
-
-        if (not self.isPSUOn and self.config['autoOn'] and (gcode in self._autoOnTriggerGCodeCommandsArray)):
-            self._logger.info("Auto-On - Turning PSU On (Triggered by {})".format(gcode))
-            self.turn_psu_on()
-
-        if self.config['powerOffWhenIdle'] and self.isPSUOn and not self._skipIdleTimer:
-            if not (gcode in self._idleIgnoreCommandsArray):
-                self._waitForHeaters = False
-                self._reset_idle_timer()
+        result = self._executor.run_callback(self._executor_key(name, action), callback, timeout)
+        if not result.ok:
+            return False
 
-        if skipQueuing:
-            return (None,)
+        handle = result.value
+        if handle is None:
+            return True
 
+        remaining = None
+        if timeout > 0:
+            remaining = max(0, timeout - result.duration)
 
-    def turn_psu_on(self):
-        if self.config['switchingMethod'] in ['GCODE', 'GPIO', 'SYSTEM', 'PLUGIN']:
-            self._logger.info("Switching PSU On")
-            if self.config['switchingMethod'] == 'GCODE':
-                self._logger.debug("Switching PSU On Using GCODE: {}".format(self.config['onGCodeCommand']))
-                self._printer.commands(self.config['onGCodeCommand'])
-            elif self.config['switchingMethod'] == 'SYSTEM':
-                self._logger.debug("Switching PSU On Using SYSTEM: {}".format(self.config['onSysCommand']))
-
-                p = subprocess.Popen(self.config['onSysCommand'], shell=True)
-                self._logger.debug("On system command executed. PID={}, Command={}".format(p.pid, self.config['onSysCommand']))
-                while p.poll() is None:
-                    time.sleep(0.1)
-                r = p.returncode
-
-                self._logger.debug("On system command returned: {}".format(r))
-            elif self.config['switchingMethod'] == 'GPIO':
-                self._logger.debug("Switching PSU On Using GPIO: {}".format(self.config['onoffGPIOPin']))
-                pin_output = bool(1 ^ self.config['invertonoffGPIOPin'])
+        try:
+            value = handle.result(remaining)
+        except concurrent.futures.TimeoutError:
+            self._logger.error('Plugin {} did not complete switching {} within {}s.'.format(p, action, timeout))
+            return False
+        except Exception:
+            self._logger.exception('Plugin {} failed switching {}'.format(p, action))
+            return False
 
-                try:
-                    self._configuredGPIOPins['switch'].write(pin_output)
-                except Exception :
-                    self._logger.exception("Exception while writing GPIO line")
-                    return
-            elif self.config['switchingMethod'] == 'PLUGIN':
-                p = self.config['switchingPlugin']
-                self._logger.debug("Switching PSU On Using PLUGIN: {}".format(p))
+        return value is not False
 
-                if p not in self._sub_plugins:
-                    self._logger.error('Plugin {} is configured for switching but it is not registered.'.format(p))
-                    return
-                elif not hasattr(self._sub_plugins[p], 'turn_psu_on'):
-                    self._logger.error('Plugin {} is configured for switching but turn_psu_on is not defined.'.format(p))
-                    return
-                else:
-                    callback = self._sub_plugins[p].turn_psu_on
-                    try:
-                        r = callback()
-                    except Exception:
-                        self._logger.exception(
-                            "Error while executing callback {}".format(
-                                callback
-                            ),
-                            extra={"callback": fqfn(callback)},
-                        )
-                        return
 
-            if self.config['sensingMethod'] not in ('GPIO', 'SYSTEM', 'PLUGIN'):
-                self._noSensing_isPSUOn = True
+    def _turn_psu_on(self):
+        if self.config.switchable:
+            self._set_power_state(POWER_STATE_SWITCHING_ON)
+            self._logger.info("Switching PSU On")
 
-            time.sleep(0.1 + self.config['postOnDelay'])
+            if not self._switch_channel(PRIMARY_CHANNEL, self.config, True):
+                return
 
-            self.check_psu_state()
+            return 0.1 + self.config.postOnDelay
 
-            if self.config['connectOnPowerOn'] and self._printer.is_closed_or_error():
-                self._printer.connect()
-                time.sleep(0.1)
 
-            if not self._printer.is_closed_or_error():
-                self._printer.script("psucontrol_post_on", must_be_set=False)
+    def _turn_psu_off(self):
+        self._autoConnect.cancel()
 
+        if self.config.switchable:
+            self._set_power_state(POWER_STATE_SWITCHING_OFF)
 
-    def turn_psu_off(self):
-        if self.config['switchingMethod'] in ['GCODE', 'GPIO', 'SYSTEM', 'PLUGIN']:
             if not self._printer.is_closed_or_error():
                 self._printer.script("psucontrol_pre_off", must_be_set=False)
 
             self._logger.info("Switching PSU Off")
-            if self.config['switchingMethod'] == 'GCODE':
-                self._logger.debug("Switching PSU Off Using GCODE: {}".format(self.config['offGCodeCommand']))
-                self._printer.commands(self.config['offGCodeCommand'])
-            elif self.config['switchingMethod'] == 'SYSTEM':
-                self._logger.debug("Switching PSU Off Using SYSTEM: {}".format(self.config['offSysCommand']))
-
-                p = subprocess.Popen(self.config['offSysCommand'], shell=True)
-                self._logger.debug("Off system command executed. PID={}, Command={}".format(p.pid, self.config['offSysCommand']))
-                while p.poll() is None:
-                    time.sleep(0.1)
-                r = p.returncode
-
-                self._logger.debug("Off system command returned: {}".format(r))
-            elif self.config['switchingMethod'] == 'GPIO':
-                self._logger.debug("Switching PSU Off Using GPIO: {}".format(self.config['onoffGPIOPin']))
-                pin_output = bool(0 ^ self.config['invertonoffGPIOPin'])
-
-                try:
-                    self._configuredGPIOPins['switch'].write(pin_output)
-                except Exception:
-                    self._logger.exception("Exception while writing GPIO line")
-                    return
-            elif self.config['switchingMethod'] == 'PLUGIN':
-                p = self.config['switchingPlugin']
-                self._logger.debug("Switching PSU Off Using PLUGIN: {}".format(p))
 
-                if p not in self._sub_plugins:
-                    self._logger.error('Plugin {} is configured for switching but it is not registered.'.format(p))
-                    return
-                elif not hasattr(self._sub_plugins[p], 'turn_psu_off'):
-                    self._logger.error('Plugin {} is configured for switching but turn_psu_off is not defined.'.format(p))
-                    return
-                else:
-                    callback = self._sub_plugins[p].turn_psu_off
-                    try:
-                        r = callback()
-                    except Exception:
-                        self._logger.exception(
-                            "Error while executing callback {}".format(
-                                callback
-                            ),
-                            extra={"callback": fqfn(callback)},
-                        )
-                        return
+            if not self._switch_channel(PRIMARY_CHANNEL, self.config, False):
+                return
 
-            if self.config['disconnectOnPowerOff']:
+            if self.config.disconnectOnPowerOff:
                 self._printer.disconnect()
 
-            if self.config['sensingMethod'] not in ('GPIO', 'SYSTEM', 'PLUGIN'):
-                self._noSensing_isPSUOn = False
+            return 0.1
 
-            time.sleep(0.1)
-            self.check_psu_state()
+
+    def _turn_channel(self, name, on):
+        channel = self.config.channels.get(name)
+        if channel is None:
+            self._logger.error("Channel {} no longer exists".format(name))
+            return
+
+        if channel.switchable:
+            self._logger.info("Switching {} {}".format(name, 'On' if on else 'Off'))
+
+            if not self._switch_channel(name, channel, on):
+                return
+
+            return 0.1
 
 
     def get_psu_state(self):
@@ -583,21 +1832,84 @@ class PSUControl(octoprint.plugin.StartupPlugin,
 
 
     def turn_on_before_printing_after_upload(self):
-        if ( self.config['turnOnWhenApiUploadPrint'] and
+        if ( self.config.turnOnWhenApiUploadPrint and
              not self.isPSUOn and
              flask.request.path.startswith('/api/files/') and
              flask.request.method == 'POST' and
              flask.request.values.get('print', 'false') in valid_boolean_trues):
-                self.on_api_command("turnPSUOn", [])
+                try:
+                    if not Permissions.PLUGIN_PSUCONTROL_CONTROL.can():
+                        return
+                except:
+                    if not user_permission.can():
+                        return
+
+                # Don't hold up the upload request for the whole power on. If the printer isn't
+                # ready by the time OctoPrint decides whether to print, the UPLOAD event starts it.
+                self._logger.info("Turning PSU On for upload and print")
+                op = self.turn_psu_on(cause=history.CAUSE_UPLOAD)
+                self._uploadPrint = (op, current_user.get_name(), time.monotonic())
+
+
+    def _on_upload(self, payload):
+        pending, self._uploadPrint = self._uploadPrint, None
+        if pending is None:
+            return
+
+        op, user, requested = pending
+        if (not payload.get('print') or payload.get('effective_print') or
+                payload.get('target') != 'local' or time.monotonic() - requested > 60):
+            return
+
+        path = payload.get('path')
+        self._logger.info("Printing {} once the printer is ready".format(path))
+
+        def powered_on(op):
+            if not op.result:
+                self._logger.warning("Not printing {}, turning the PSU on failed".format(path))
+                return
+
+            if not self._autoConnect.when_done(lambda result, elapsed: self._print_uploaded(path, user, requested)):
+                self._print_uploaded(path, user, requested)
+
+        op.add_done_callback(powered_on)
+
+
+    def _print_uploaded(self, path, user, requested):
+        if not self._printer.is_operational():
+            self._logger.warning("Not printing {}, the printer is not connected".format(path))
+            return
+
+        if self._printer.is_printing() or self._printer.is_paused():
+            self._logger.warning("Not printing {}, the printer is busy".format(path))
+            return
+
+        self._logger.info("Starting print of {} {:.2f}s after it was uploaded".format(path, time.monotonic() - requested))
+        try:
+            self._printer.select_file(path, False, printAfterSelect=True, user=user)
+        except Exception:
+            self._logger.exception("Exception while starting print of {}".format(path))
 
 
     def on_event(self, event, payload):
         if event == Events.CLIENT_OPENED:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(isPSUOn=self.isPSUOn))
+            self._plugin_manager.send_plugin_message(self._identifier, self._get_state_message())
             return
-        elif event == Events.ERROR and self.config['turnOffWhenError']:
+        elif event == Events.UPLOAD:
+            self._on_upload(payload)
+            return
+
+        if event in (Events.CONNECTED, Events.DISCONNECTED, Events.ERROR):
+            connecting = self._autoConnect.connecting
+            self._autoConnect.on_event(event, payload)
+
+            if connecting and event == Events.ERROR:
+                # A failed attempt is retried, it mustn't switch the PSU back off.
+                return
+
+        if event == Events.ERROR and self.config.turnOffWhenError:
             self._logger.info("Firmware or communication error detected. Turning PSU Off")
-            self.turn_psu_off()
+            self.turn_psu_off(cause=history.CAUSE_ERROR)
             return
 
 
@@ -606,12 +1918,108 @@ class PSUControl(octoprint.plugin.StartupPlugin,
             turnPSUOn=[],
             turnPSUOff=[],
             togglePSU=[],
-            getPSUState=[]
+            getPSUState=[],
+            batch=['operations']
         )
 
 
     def on_api_get(self, request):
-        return self.on_api_command("getPSUState", [])
+        if 'metrics' in request.values:
+            try:
+                if not Permissions.STATUS.can():
+                    return make_response("Insufficient rights", 403)
+            except:
+                if not user_permission.can():
+                    return make_response("Insufficient rights", 403)
+
+            response = make_response(self._metrics.render())
+            response.headers['Content-Type'] = Registry.CONTENT_TYPE
+            return response
+
+        if 'sensing' in request.values:
+            try:
+                if not Permissions.STATUS.can():
+                    return make_response("Insufficient rights", 403)
+            except:
+                if not user_permission.can():
+                    return make_response("Insufficient rights", 403)
+
+            return jsonify(self._get_sensing_stats())
+
+        if 'batch' in request.values:
+            try:
+                if not Permissions.STATUS.can():
+                    return make_response("Insufficient rights", 403)
+            except:
+                if not user_permission.can():
+                    return make_response("Insufficient rights", 403)
+
+            batch = self._batches.get(request.values['batch'])
+            if batch is None:
+                return make_response("Unknown batch: {}".format(request.values['batch']), 404)
+
+            return jsonify(batch=batch.id, done=batch.done, results=batch.result)
+
+        if 'history' in request.values or 'ontime' in request.values:
+            try:
+                if not Permissions.STATUS.can():
+                    return make_response("Insufficient rights", 403)
+            except:
+                if not user_permission.can():
+                    return make_response("Insufficient rights", 403)
+
+            now = time.time()
+            try:
+                start = float(request.values['from']) if 'from' in request.values else None
+                end = float(request.values['to']) if 'to' in request.values else None
+            except ValueError:
+                return make_response("from and to must be unix timestamps", 400)
+
+            if 'history' in request.values:
+                return jsonify(entries=self._history.entries(start, end), isPSUOn=self.isPSUOn)
+
+            if start is None:
+                # Midnight six days ago, so the last seven calendar days.
+                day = datetime.date.fromtimestamp(now) - datetime.timedelta(days=6)
+                start = time.mktime(day.timetuple())
+
+            return jsonify(days=self._history.on_time_per_day(start, end if end is not None else now, now))
+
+        channel = request.values.get('channel')
+
+        # Taken before the body so a change in between yields a stale tag, never a stale 304.
+        # The countdown is part of the body, so the tag changes with every second of it.
+        eta = self.get_cooldown_eta()
+        key = (channel,) + self._get_state_key() + (None if eta is None else int(round(eta)),)
+        etag = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+
+        response = self.on_api_command("getPSUState", dict(channel=channel))
+        if response.status_code != 200:
+            return response
+
+        response.set_etag(etag)
+        return response.make_conditional(request)
+
+
+    def _get_sensing_stats(self):
+        sense_filter = self._senseFilter
+        rejected = sense_filter.rejected if sense_filter is not None else dict()
+
+        channels = dict()
+        for name, (group, pin) in self._gpioSenseLines.items():
+            channels[name] = dict(pin=pin, glitchesRejected=rejected.get((group.path, pin), 0))
+
+        return dict(filter=sense_filter.mode if sense_filter is not None else None, channels=channels)
+
+
+    def _resolve_channel(self, channel):
+        # None selects the primary PSU, False means the name is unknown.
+        if channel in (None, '', PRIMARY_CHANNEL):
+            return None
+        elif channel not in self.config.channels:
+            return False
+
+        return channel
 
 
     def on_api_command(self, command, data):
@@ -622,6 +2030,13 @@ class PSUControl(octoprint.plugin.StartupPlugin,
             except:
                 if not user_permission.can():
                     return make_response("Insufficient rights", 403)
+        elif command in ['batch']:
+            try:
+                if not Permissions.PLUGIN_PSUCONTROL_CONTROL.can():
+                    return make_response("Insufficient rights", 403)
+            except:
+                if not user_permission.can():
+                    return make_response("Insufficient rights", 403)
         elif command in ['getPSUState']:
             try:
                 if not Permissions.STATUS.can():
@@ -630,17 +2045,63 @@ class PSUControl(octoprint.plugin.StartupPlugin,
                 if not user_permission.can():
                     return make_response("Insufficient rights", 403)
 
-        if command == 'turnPSUOn':
-            self.turn_psu_on()
-        elif command == 'turnPSUOff':
-            self.turn_psu_off()
-        elif command == 'togglePSU':
-            if self.isPSUOn:
-                self.turn_psu_off()
-            else:
-                self.turn_psu_on()
+        if command == 'batch':
+            steps = []
+            total_delay = 0.0
+            operations = data.get('operations')
+            if not isinstance(operations, list) or not operations:
+                return make_response("operations must be a non-empty list", 400)
+
+            for operation in operations:
+                if not isinstance(operation, dict) or operation.get('command') not in ['turnPSUOn', 'turnPSUOff', 'togglePSU']:
+                    return make_response("Invalid operation: {}".format(operation), 400)
+
+                channel = self._resolve_channel(operation.get('channel'))
+                if channel is False:
+                    return make_response("Unknown channel: {}".format(operation.get('channel')), 404)
+
+                try:
+                    delay = float(operation.get('delay', 0))
+                except (TypeError, ValueError):
+                    return make_response("Invalid delay: {}".format(operation.get('delay')), 400)
+
+                # Also rejects NaN.
+                if not 0 <= delay <= BATCH_MAX_DELAY:
+                    return make_response("delay must be between 0 and {}s".format(BATCH_MAX_DELAY), 400)
+
+                total_delay += delay
+                steps.append((operation['command'], channel, delay))
+
+            if total_delay > BATCH_MAX_TOTAL_DELAY:
+                return make_response("Delays of a batch must not add up to more than {}s".format(BATCH_MAX_TOTAL_DELAY), 400)
+
+            batch = self.run_batch(steps)
+
+            if data.get('wait', False) in valid_boolean_trues:
+                results = batch.wait(BATCH_WAIT_TIMEOUT)
+                if not batch.done:
+                    return make_response(jsonify(batch=batch.id, **self._get_state_message()), 202)
+
+                return jsonify(batch=batch.id, results=results, **self._get_state_message())
+
+            return jsonify(batch=batch.id, **self._get_state_message())
+
+        channel = self._resolve_channel(data.get('channel') if data else None)
+        if channel is False:
+            return make_response("Unknown channel: {}".format(data.get('channel')), 404)
+
+        if command in ['turnPSUOn', 'turnPSUOff', 'togglePSU']:
+            op = self._switch_command(command, channel)
+
+            if data and data.get('wait', False) in valid_boolean_trues:
+                # Powering on can take as long as the connect timeout, don't hold the worker that long.
+                op.wait(BATCH_WAIT_TIMEOUT)
+                if not op.done:
+                    return make_response(jsonify(**self._get_state_message(channel)), 202)
+
+            return jsonify(**self._get_state_message(channel))
         elif command == 'getPSUState':
-            return jsonify(isPSUOn=self.isPSUOn)
+            return jsonify(**self._get_state_message(channel))
 
 
     def on_settings_save(self, data):
@@ -654,20 +2115,33 @@ class PSUControl(octoprint.plugin.StartupPlugin,
             self._settings.saveScript("gcode", "psucontrol_pre_off", u'' + script.replace("\r\n", "\n").replace("\r", "\n"))
             data.pop('scripts_gcode_psucontrol_pre_off')
 
-        old_config = self.config.copy()
+        old_config = self.config
 
         octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
 
         self.reload_settings()
 
-        #cleanup GPIO
-        self.cleanup_gpio()
+        changed = changed_fields(old_config, self.config)
+        self._logger.debug("Changed settings: {}".format(', '.join(sorted(changed))))
 
-        #configure GPIO
-        if self.config['switchingMethod'] == 'GPIO' or self.config['sensingMethod'] == 'GPIO':
-            self.configure_gpio()
+        persistent = set(self._executor_key(name, 'Sensing') for name, channel in self._iter_channels()
+                         if channel.sensingMethod == 'SYSTEM' and channel.senseSystemCommandPersistent)
+        for key in self._executor.persistent_keys():
+            if key not in persistent:
+                self._executor.stop_persistent(key)
 
-        self._start_idle_timer()
+        # Lines, timers and polling are only touched when their settings changed, reopening
+        # an output line that didn't change could glitch the relay.
+        self._reconfigure_gpio()
+
+        if changed & {'powerOffWhenIdle', 'idleTimeout'}:
+            self._start_idle_timer()
+
+        if 'stateMessageHeartbeatInterval' in changed:
+            self._start_state_heartbeat()
+
+        if changed & _SENSING_FIELDS:
+            self.check_psu_state()
 
 
     def get_wizard_version(self):
@@ -765,10 +2239,11 @@ class PSUControl(octoprint.plugin.StartupPlugin,
                         self._logger.info("Converting pin number from BOARD to BCM. senseGPIOPin={} -> senseGPIOPin={}".format(cur_senseGPIOPin, p))
                         self._settings.set_int(["senseGPIOPin"], p)
 
-                if len(self._availableGPIODevices) > 0:
+                available_devices = self._get_available_gpio_devices()
+                if len(available_devices) > 0:
                     # This was likely a Raspberry Pi using RPi.GPIO. Set GPIODevice to the first dev found which is likely /dev/gpiochip0
-                    self._logger.info("Setting GPIODevice to the first found. GPIODevice={}".format(self._availableGPIODevices[0]))
-                    self._settings.set(["GPIODevice"], self._availableGPIODevices[0])
+                    self._logger.info("Setting GPIODevice to the first found. GPIODevice={}".format(available_devices[0]))
+                    self._settings.set(["GPIODevice"], available_devices[0])
                 else:
                     # GPIO was used for either but no GPIO devices exist. Reset to defaults.
                     self._logger.warning("No GPIO devices found. Reverting switchingMethod and sensingMethod to defaults.")
@@ -800,10 +2275,10 @@ class PSUControl(octoprint.plugin.StartupPlugin,
             available_plugins.append(dict(pluginIdentifier=k, displayName=self._plugin_manager.plugins[k].name))
 
         return {
-            "availableGPIODevices": self._availableGPIODevices,
+            "availableGPIODevices": self._get_available_gpio_devices(),
             "availablePlugins": available_plugins,
-            "hasGPIO": HAS_GPIO,
-            "supportsLineBias": SUPPORTS_LINE_BIAS
+            "hasGPIO": has_gpio(),
+            "supportsLineBias": supports_line_bias()
         }
 
 
@@ -840,7 +2315,7 @@ class PSUControl(octoprint.plugin.StartupPlugin,
 
 
     def register_custom_events(self):
-        return ["psu_state_changed"]
+        return ["psu_state_changed", "channel_state_changed"]
 
 
     def get_additional_permissions(self, *args, **kwargs):
@@ -858,8 +2333,22 @@ class PSUControl(octoprint.plugin.StartupPlugin,
         return [self.turn_on_before_printing_after_upload]
 
 
+    def _hook_octoprint_server_http_routes(self, server_routes, *args, **kwargs):
+        # Served by Tornado directly so waiting clients don't each hold one of the WSGI worker threads.
+        from octoprint.server import app
+        from octoprint.server.util.flask import permission_validator
+        from octoprint.server.util.tornado import access_validation_factory
+
+        return [
+            (r"/state/stream", StateStreamHandler, dict(
+                broadcaster=self._stateBroadcaster,
+                access_validation=access_validation_factory(app, permission_validator, Permissions.STATUS)
+            ))
+        ]
+
+
 __plugin_name__ = "PSU Control"
-__plugin_pythoncompat__ = ">=2.7,<4"
+__plugin_pythoncompat__ = ">=3.7,<4"
 
 def __plugin_load__():
     global __plugin_implementation__
@@ -873,12 +2362,21 @@ def __plugin_load__():
         "octoprint.access.permissions": __plugin_implementation__.get_additional_permissions,
         "octoprint.cli.commands": cli.commands,
         "octoprint.server.api.before_request": __plugin_implementation__._hook_octoprint_server_api_before_request,
+        "octoprint.server.http.routes": __plugin_implementation__._hook_octoprint_server_http_routes,
     }
 
     global __plugin_helpers__
     __plugin_helpers__ = dict(
         get_psu_state = __plugin_implementation__.get_psu_state,
+        get_power_state = __plugin_implementation__.get_power_state,
         turn_psu_on = __plugin_implementation__.turn_psu_on,
         turn_psu_off = __plugin_implementation__.turn_psu_off,
-        register_plugin = __plugin_implementation__.register_plugin
+        get_channels = __plugin_implementation__.get_channels,
+        get_channel_state = __plugin_implementation__.get_channel_state,
+        turn_channel_on = __plugin_implementation__.turn_channel_on,
+        turn_channel_off = __plugin_implementation__.turn_channel_off,
+        register_plugin = __plugin_implementation__.register_plugin,
+        register_plugin_v2 = __plugin_implementation__.register_plugin_v2
     )
+
+_IMPORT_DURATION = time.monotonic() - _IMPORT_STARTED
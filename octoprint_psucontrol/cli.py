@@ -9,23 +9,44 @@ def commands(cli_group, pass_octoprint_ctx, *args, **kwargs):
     import click
     import sys
     import json
+    import time
+    import concurrent.futures
+    import requests
+    import requests.adapters
     import requests.exceptions
     from octoprint.cli.client import create_client, client_options
 
-    def _api_command(command, apikey, host, port, httpuser, httppass, https, prefix):
+    # octoprint_client opens a new session per request, share one so connections are kept alive.
+    session = requests.Session()
+
+    def _create_client(apikey, host, port, httpuser, httppass, https, prefix):
         if prefix == None:
             prefix = '/api'
 
-        client = create_client(settings=cli_group.settings,
-                               apikey=apikey,
-                               host=host,
-                               port=port,
-                               httpuser=httpuser,
-                               httppass=httppass,
-                               https=https,
-                               prefix=prefix)
-
-        r = client.post_command("plugin/psucontrol", command)
+        return create_client(settings=cli_group.settings,
+                             apikey=apikey,
+                             host=host,
+                             port=port,
+                             httpuser=httpuser,
+                             httppass=httppass,
+                             https=https,
+                             prefix=prefix)
+
+    def _post_command(client, command, channel=None, wait=False):
+        data = dict(command=command)
+        if channel:
+            data['channel'] = channel
+        if wait:
+            data['wait'] = True
+
+        request = client.prepare_request("POST", "plugin/psucontrol")
+        request.prepare_body(None, None, json=data)
+        return session.send(request, timeout=30)
+
+    def _api_command(command, apikey, host, port, httpuser, httppass, https, prefix, channel=None):
+        client = _create_client(apikey, host, port, httpuser, httppass, https, prefix)
+
+        r = _post_command(client, command, channel)
         try:
             r.raise_for_status()
         except requests.exceptions.HTTPError as e:
@@ -34,39 +55,128 @@ def commands(cli_group, pass_octoprint_ctx, *args, **kwargs):
 
         return r
 
+    def _load_targets(targets, hosts_file):
+        entries = list(targets)
+        if hosts_file is not None:
+            for line in hosts_file:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    entries.append(line)
+
+        result = []
+        for entry in entries:
+            # host[:port] [apikey]
+            parts = entry.split()
+            host, _, port = parts[0].partition(':')
+            try:
+                port = int(port) if port else None
+            except ValueError:
+                raise click.BadParameter("Invalid port in {}".format(parts[0]))
+
+            result.append((parts[0], host, port, parts[1] if len(parts) > 1 else None))
+
+        return result
+
+    def _fan_out(command, channel, targets, parallel, apikey, httpuser, httppass, https, prefix, return_int=False):
+        parallel = max(1, min(parallel, len(targets)))
+        adapter = requests.adapters.HTTPAdapter(pool_connections=len(targets), pool_maxsize=parallel)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        def run(target):
+            name, host, port, target_apikey = target
+            start = time.monotonic()
+            try:
+                client = _create_client(target_apikey or apikey, host, port, httpuser, httppass, https, prefix)
+                r = _post_command(client, command, channel, wait=(command != 'getPSUState'))
+                r.raise_for_status()
+                return (name, r.json().get('isPSUOn'), None, time.monotonic() - start)
+            except Exception as e:
+                return (name, None, str(e), time.monotonic() - start)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+            results = list(executor.map(run, targets))
+
+        width = max([len("HOST")] + [len(name) for name, _, _, _ in results])
+        click.echo("{:<{w}}  {:<5}  {:>8}  {}".format("HOST", "STATE", "TIME", "ERROR", w=width))
+
+        counts = dict(on=0, off=0, error=0)
+        for name, isOn, error, duration in results:
+            if error is not None:
+                state = 'error'
+            else:
+                state = 'on' if isOn else 'off'
+            counts[state] += 1
+            if return_int and error is None:
+                state = str(int(bool(isOn)))
+            click.echo("{:<{w}}  {:<5}  {:>6.0f}ms  {}".format(name, state, duration * 1000, error or '', w=width))
+
+        click.echo("{} on, {} off, {} failed".format(counts['on'], counts['off'], counts['error']))
+
+        # With --return-int scripts check the exit code, so it is only 0 if every host is on.
+        if return_int:
+            return counts['error'] == 0 and counts['off'] == 0
+
+        return counts['error'] == 0
+
+    def fan_out_options(f):
+        f = click.option("--parallel", type=click.INT, default=16, show_default=True, help="Number of hosts to contact concurrently.")(f)
+        f = click.option("--hosts-file", type=click.File("r"), help="File with one host[:port] [apikey] per line.")(f)
+        f = click.option("--target", "targets", multiple=True, help="Additional host[:port] to send the command to. May be repeated.")(f)
+        return f
+
+    def _run(command, channel, targets, hosts_file, parallel, apikey, host, port, httpuser, httppass, https, prefix, return_int=False):
+        targets = _load_targets(targets, hosts_file)
+        if not targets:
+            return _api_command(command, apikey, host, port, httpuser, httppass, https, prefix, channel=channel)
+
+        if host:
+            targets.insert(0, (host if not port else "{}:{}".format(host, port), host, port, None))
+
+        ok = _fan_out(command, channel, targets, parallel, apikey, httpuser, httppass, https, prefix, return_int)
+        sys.exit(0 if ok else 1)
+
+    @fan_out_options
+    @click.option("--channel", help="Name of the channel to switch. Defaults to the main PSU.")
     @client_options
     @click.command("on")
-    def turnPSUOn_command(apikey, host, port, httpuser, httppass, https, prefix):
+    def turnPSUOn_command(channel, targets, hosts_file, parallel, apikey, host, port, httpuser, httppass, https, prefix):
         """Turn the PSU On"""
-        r = _api_command('turnPSUOn', apikey, host, port, httpuser, httppass, https, prefix)
+        r = _run('turnPSUOn', channel, targets, hosts_file, parallel, apikey, host, port, httpuser, httppass, https, prefix)
 
         if r.status_code in [200, 204]:
             click.echo('ok')
 
+    @fan_out_options
+    @click.option("--channel", help="Name of the channel to switch. Defaults to the main PSU.")
     @client_options
     @click.command("off")
-    def turnPSUOff_command(apikey, host, port, httpuser, httppass, https, prefix):
+    def turnPSUOff_command(channel, targets, hosts_file, parallel, apikey, host, port, httpuser, httppass, https, prefix):
         """Turn the PSU Off"""
-        r = _api_command('turnPSUOff', apikey, host, port, httpuser, httppass, https, prefix)
+        r = _run('turnPSUOff', channel, targets, hosts_file, parallel, apikey, host, port, httpuser, httppass, https, prefix)
 
         if r.status_code in [200, 204]:
             click.echo('ok')
 
+    @fan_out_options
+    @click.option("--channel", help="Name of the channel to switch. Defaults to the main PSU.")
     @client_options
     @click.command("toggle")
-    def togglePSU_command(apikey, host, port, httpuser, httppass, https, prefix):
+    def togglePSU_command(channel, targets, hosts_file, parallel, apikey, host, port, httpuser, httppass, https, prefix):
         """Toggle the PSU On/Off"""
-        r = _api_command('togglePSU', apikey, host, port, httpuser, httppass, https, prefix)
+        r = _run('togglePSU', channel, targets, hosts_file, parallel, apikey, host, port, httpuser, httppass, https, prefix)
 
         if r.status_code in [200, 204]:
             click.echo('ok')
 
-    @click.option("--return-int", is_flag=True, help="Return the PSU state as a boolean integer.")
+    @fan_out_options
+    @click.option("--channel", help="Name of the channel to query. Defaults to the main PSU.")
+    @click.option("--return-int", is_flag=True, help="Return the PSU state as a boolean integer. With several hosts the exit code is 0 only if all of them are on.")
     @client_options
     @click.command("status")
-    def getPSUState_command(return_int, apikey, host, port, httpuser, httppass, https, prefix):
+    def getPSUState_command(channel, return_int, targets, hosts_file, parallel, apikey, host, port, httpuser, httppass, https, prefix):
         """Get the current PSU status"""
-        r = _api_command('getPSUState', apikey, host, port, httpuser, httppass, https, prefix)
+        r = _run('getPSUState', channel, targets, hosts_file, parallel, apikey, host, port, httpuser, httppass, https, prefix, return_int)
 
         if r.status_code in [200, 204]:
             data = json.loads(r._content)
@@ -79,5 +189,61 @@ def commands(cli_group, pass_octoprint_ctx, *args, **kwargs):
                 else:
                     click.echo('off')
 
-    return [turnPSUOn_command, turnPSUOff_command, togglePSU_command, getPSUState_command]
+    @client_options
+    @click.command("watch")
+    def watch_command(apikey, host, port, httpuser, httppass, https, prefix):
+        """Print PSU state changes as they happen"""
+        if prefix == None:
+            prefix = '/api'
+
+        # The stream is served next to the API rather than below it.
+        root = prefix[:-len('/api')] if prefix.endswith('/api') else prefix
+        client = _create_client(apikey, host, port, httpuser, httppass, https, root)
+
+        last_id = None
+        delay = 1
+
+        def show(event):
+            data = json.loads(event['data'])
+            line = "{} {:<13} {}".format(time.strftime("%Y-%m-%d %H:%M:%S"), data.get('state', ''), 'on' if data.get('isPSUOn') else 'off')
+            for name, isOn in sorted(data.get('channels', {}).items()):
+                line += " {}={}".format(name, 'on' if isOn else 'off')
+            click.echo(line)
+
+        try:
+            while True:
+                request = client.prepare_request("GET", "plugin/psucontrol/state/stream")
+                request.headers['Accept'] = 'text/event-stream'
+                if last_id is not None:
+                    request.headers['Last-Event-ID'] = last_id
+
+                try:
+                    # The server sends a keepalive every 15 seconds.
+                    r = session.send(request, stream=True, timeout=(10, 60))
+                    r.raise_for_status()
+                    delay = 1
+
+                    event = dict()
+                    for line in r.iter_lines(decode_unicode=True):
+                        if not line:
+                            if 'data' in event:
+                                last_id = event.get('id', last_id)
+                                show(event)
+                            event = dict()
+                        elif not line.startswith(':'):
+                            field, _, value = line.partition(':')
+                            event[field] = value[1:] if value.startswith(' ') else value
+                except requests.exceptions.HTTPError as e:
+                    click.echo("HTTP Error, got {}".format(e))
+                    if e.response is not None and 400 <= e.response.status_code < 500:
+                        sys.exit(1)
+                except requests.exceptions.RequestException as e:
+                    click.echo("Connection lost ({}). Reconnecting in {}s".format(e, delay))
+
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+        except KeyboardInterrupt:
+            pass
+
+    return [turnPSUOn_command, turnPSUOff_command, togglePSU_command, getPSUState_command, watch_command]
 
@@ -0,0 +1,226 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Shawn Bruce <kantlivelong@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2021 Shawn Bruce - Released under terms of the AGPLv3 License"
+
+import types
+
+from octoprint.settings import valid_boolean_trues
+
+SWITCHING_METHODS = ('GCODE', 'GPIO', 'SYSTEM', 'PLUGIN')
+EXTERNAL_SENSING_METHODS = ('GPIO', 'SYSTEM', 'PLUGIN')
+
+# Settings shared by the PSU and every additional channel. A new setting has to
+# be added here or to _GLOBAL_FIELDS as well as to the plugin's defaults.
+_CHANNEL_FIELDS = (
+    'GPIODevice',
+    'switchingMethod',
+    'onoffGPIOPin',
+    'invertonoffGPIOPin',
+    'onGCodeCommand',
+    'offGCodeCommand',
+    'onSysCommand',
+    'offSysCommand',
+    'switchingPlugin',
+    'sensingMethod',
+    'senseGPIOPin',
+    'invertsenseGPIOPin',
+    'senseGPIOPinPUD',
+    'senseGPIOPinEdgeDetection',
+    'senseSystemCommand',
+    'senseSystemCommandPersistent',
+    'sensingPlugin',
+)
+
+_GLOBAL_FIELDS = (
+    'enablePseudoOnOff',
+    'pseudoOnGCodeCommand',
+    'pseudoOffGCodeCommand',
+    'postOnDelay',
+    'postOnWaitForSense',
+    'postOnWaitForPort',
+    'postOnWaitForPrinter',
+    'connectOnPowerOn',
+    'connectTimeout',
+    'disconnectOnPowerOff',
+    'sensePollingInterval',
+    'sensePollingMaxInterval',
+    'sensePollingFastInterval',
+    'sensePollingFastWindow',
+    'senseGPIOFilter',
+    'senseGPIOFilterSamples',
+    'senseGPIOFilterThreshold',
+    'senseGPIOFilterStableTime',
+    'senseGPIOFilterSampleInterval',
+    'autoOn',
+    'autoOnTriggerGCodeCommands',
+    'enablePowerOffWarningDialog',
+    'powerOffWhenIdle',
+    'idleTimeout',
+    'idleIgnoreCommands',
+    'idleTimeoutWaitTemp',
+    'turnOnWhenApiUploadPrint',
+    'turnOffWhenError',
+    'stateMessageCoalesceDelay',
+    'stateMessageHeartbeatInterval',
+    'sensingTimeout',
+    'switchingTimeout',
+    'switchingFailOnExitCode',
+)
+
+
+class _Frozen(object):
+    __slots__ = ()
+
+    def _set(self, name, value):
+        object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{} is read-only".format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError("{} is read-only".format(type(self).__name__))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, k) == getattr(other, k) for k in self._fields())
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join("{}={!r}".format(k, getattr(self, k)) for k in self._fields()))
+
+    @classmethod
+    def _fields(cls):
+        fields = []
+        for klass in reversed(cls.__mro__):
+            fields.extend(getattr(klass, '__slots__', ()))
+        return fields
+
+
+class ChannelConfig(_Frozen):
+    """
+    Read-only settings of one switching/sensing channel.
+
+    Besides the settings it carries fields derived from them once, so the
+    state check loop and switching don't have to.
+    """
+
+    __slots__ = _CHANNEL_FIELDS + ('name', 'switchable', 'internalSensing', 'usesGPIO', 'gpioOutputLevels')
+
+    def __init__(self, name, values):
+        for k in _CHANNEL_FIELDS:
+            self._set(k, values[k])
+
+        self._set('name', name)
+        self._set('switchable', self.switchingMethod in SWITCHING_METHODS)
+        self._set('internalSensing', self.sensingMethod not in EXTERNAL_SENSING_METHODS)
+        self._set('usesGPIO', self.switchingMethod == 'GPIO' or self.sensingMethod == 'GPIO')
+        # Output level for (off, on), with the inversion applied.
+        self._set('gpioOutputLevels', (bool(self.invertonoffGPIOPin), not self.invertonoffGPIOPin))
+
+
+class Config(ChannelConfig):
+    """
+    Read-only snapshot of all plugin settings.
+
+    The PSU's own switching/sensing settings make it the config of the primary
+    channel. ``channels`` maps the names of the additional channels to their
+    ChannelConfig. A new snapshot is compiled on every settings change and
+    swapped in as a whole, so a reader holding one never sees a partial update.
+    """
+
+    __slots__ = _GLOBAL_FIELDS + ('autoOnTriggerGCodeCommandSet', 'idleIgnoreCommandSet', 'channels')
+
+    def __init__(self, name, values, channels):
+        ChannelConfig.__init__(self, name, values)
+
+        for k in _GLOBAL_FIELDS:
+            self._set(k, values[k])
+
+        self._set('autoOnTriggerGCodeCommandSet', frozenset(c.strip() for c in self.autoOnTriggerGCodeCommands.split(',')))
+        self._set('idleIgnoreCommandSet', frozenset(c.strip() for c in self.idleIgnoreCommands.split(',')))
+        self._set('channels', types.MappingProxyType(channels))
+
+
+def _compile_channels(entries, defaults, primary, values, logger, gpio_available):
+    channels = dict()
+
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+
+        channel = dict()
+        for k, v in defaults.items():
+            value = entry.get(k, v)
+            try:
+                if type(v) == bool:
+                    value = value in valid_boolean_trues
+                elif type(v) == int:
+                    value = int(value)
+                else:
+                    value = str(value).strip()
+            except (TypeError, ValueError):
+                logger.warning("Invalid value for {} of channel {}: {}. Using {}.".format(k, entry.get('name'), value, v))
+                value = v
+
+            channel[k] = value
+
+        name = channel['name']
+        if not name or name == primary or name in channels:
+            logger.error("Ignoring channel with a missing or duplicate name: '{}'".format(name))
+            continue
+
+        if channel['GPIODevice'] == '':
+            channel['GPIODevice'] = values['GPIODevice']
+
+        if channel['switchingMethod'] == 'GPIO' and not gpio_available():
+            logger.error("Unable to use GPIO for switchingMethod of channel {}.".format(name))
+            channel['switchingMethod'] = ''
+
+        if channel['sensingMethod'] == 'GPIO' and not gpio_available():
+            logger.error("Unable to use GPIO for sensingMethod of channel {}.".format(name))
+            channel['sensingMethod'] = ''
+
+        logger.debug("Channel {}: {}".format(name, channel))
+        channels[name] = ChannelConfig(name, channel)
+
+    return channels
+
+
+def compile_config(values, channel_defaults, primary, logger, gpio_available):
+    """
+    Validates the raw setting values and builds a Config snapshot from them.
+
+    ``gpio_available`` is only called when GPIO is actually configured so the
+    GPIO backend isn't loaded needlessly.
+    """
+    values = dict(values)
+
+    if values['switchingMethod'] == 'GPIO' and not gpio_available():
+        logger.error("Unable to use GPIO for switchingMethod.")
+        values['switchingMethod'] = ''
+
+    if values['sensingMethod'] == 'GPIO' and not gpio_available():
+        logger.error("Unable to use GPIO for sensingMethod.")
+        values['sensingMethod'] = ''
+
+    if values['enablePseudoOnOff'] and values['switchingMethod'] == 'GCODE':
+        logger.warning("Pseudo On/Off cannot be used in conjunction with GCODE switching. Disabling.")
+        values['enablePseudoOnOff'] = False
+
+    channels = _compile_channels(values['channels'], channel_defaults, primary, values, logger, gpio_available)
+
+    return Config(primary, values, channels)
+
+
+def changed_fields(old, new):
+    """Names of the settings that differ between two Config snapshots. Any channel change is reported as ``channels``."""
+    if old is None:
+        return set(new._fields())
+
+    return set(k for k in new._fields() if getattr(old, k) != getattr(new, k))
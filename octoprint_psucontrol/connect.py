@@ -0,0 +1,183 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Shawn Bruce <kantlivelong@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2021 Shawn Bruce - Released under terms of the AGPLv3 License"
+
+import threading
+import time
+
+from octoprint.events import Events
+
+PORT_CHECK_MIN = 0.1
+PORT_CHECK_MAX = 2.0
+RETRY_MIN = 0.5
+RETRY_MAX = 8.0
+
+_IDLE = 'idle'
+_WAITING_FOR_PORT = 'waiting_for_port'
+_CONNECTING = 'connecting'
+_RETRYING = 'retrying'
+
+
+class AutoConnect(object):
+    """
+    Connects to the printer after the PSU was switched on.
+
+    Nothing blocks: the serial port is checked from the scheduler with a
+    backoff until it shows up, the connect attempt is followed through
+    OctoPrint's connection events and failed attempts are retried with a
+    bounded backoff until ``timeout`` has passed. Callbacks added with
+    start() or when_done() are called with True once the printer is
+    operational, False when giving up and None when cancelled, and the
+    seconds since the start.
+    """
+
+    def __init__(self, printer, scheduler, logger, port_ready):
+        self._printer = printer
+        self._scheduler = scheduler
+        self._logger = logger
+        self._port_ready = port_ready
+
+        self._lock = threading.Lock()
+        self._state = _IDLE
+        self._generation = 0
+        self._callbacks = []
+        self._started = 0
+        self._attempts = 0
+        self._portDelay = PORT_CHECK_MIN
+
+
+    @property
+    def active(self):
+        return self._state != _IDLE
+
+
+    @property
+    def connecting(self):
+        return self._state == _CONNECTING
+
+
+    def start(self, timeout, callback=None):
+        with self._lock:
+            if callback is not None:
+                self._callbacks.append(callback)
+
+            if self._state != _IDLE:
+                return
+
+            self._generation += 1
+            self._started = time.monotonic()
+            self._attempts = 0
+            self._portDelay = PORT_CHECK_MIN
+            self._state = _WAITING_FOR_PORT
+            generation = self._generation
+
+        self._scheduler.schedule(0, self._step, generation)
+        self._scheduler.schedule(timeout, self._expire, generation)
+
+
+    def when_done(self, callback):
+        """Adds a callback to a running auto connect. Returns False if none is running."""
+        with self._lock:
+            if self._state == _IDLE:
+                return False
+
+            self._callbacks.append(callback)
+            return True
+
+
+    def cancel(self):
+        self._done(None, None)
+
+
+    def on_event(self, event, payload):
+        if self._state == _IDLE:
+            return
+
+        if event == Events.CONNECTED:
+            self._done(None, True)
+        elif event in (Events.ERROR, Events.DISCONNECTED):
+            with self._lock:
+                if self._state != _CONNECTING:
+                    return
+
+                delay = min(RETRY_MAX, RETRY_MIN * 2 ** (self._attempts - 1))
+                self._state = _RETRYING
+                generation = self._generation
+
+            self._logger.info("Connecting to the printer failed (attempt {}), retrying in {:.1f}s".format(self._attempts, delay))
+            self._scheduler.schedule(delay, self._step, generation)
+
+
+    def _step(self, generation):
+        with self._lock:
+            if generation != self._generation or self._state not in (_WAITING_FOR_PORT, _RETRYING):
+                return
+
+        if not self._printer.is_closed_or_error():
+            if self._printer.is_operational():
+                self._done(generation, True)
+            # Otherwise someone else started connecting, follow that attempt.
+            with self._lock:
+                if generation == self._generation and self._state != _IDLE:
+                    self._state = _CONNECTING
+            return
+
+        try:
+            ready = self._port_ready()
+        except Exception:
+            self._logger.exception("Exception while checking for the serial port")
+            ready = True
+
+        if not ready:
+            with self._lock:
+                delay = self._portDelay
+                self._portDelay = min(PORT_CHECK_MAX, delay * 2)
+            self._scheduler.schedule(delay, self._step, generation)
+            return
+
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._attempts += 1
+            self._state = _CONNECTING
+
+        self._logger.info("Connecting to the printer ({:.2f}s after power on, attempt {})".format(time.monotonic() - self._started, self._attempts))
+        try:
+            self._printer.connect()
+        except Exception:
+            self._logger.exception("Exception while connecting to the printer")
+            self.on_event(Events.ERROR, None)
+
+
+    def _expire(self, generation):
+        # In case the CONNECTED event got lost.
+        if self._printer.is_operational():
+            self._done(generation, True)
+            return
+
+        self._done(generation, False, "gave up after {} attempt(s)".format(self._attempts))
+
+
+    def _done(self, generation, connected, reason=None):
+        with self._lock:
+            if self._state == _IDLE or (generation is not None and generation != self._generation):
+                return
+
+            self._generation += 1
+            self._state = _IDLE
+            callbacks, self._callbacks = self._callbacks, []
+            elapsed = time.monotonic() - self._started
+
+        if connected:
+            self._logger.info("Printer connected {:.2f}s after power on".format(elapsed))
+        elif reason is not None:
+            self._logger.warning("Not connecting to the printer, {}".format(reason))
+
+        for callback in callbacks:
+            try:
+                callback(connected, elapsed)
+            except Exception:
+                self._logger.exception("Error while executing callback {}".format(callback))
@@ -0,0 +1,151 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Shawn Bruce <kantlivelong@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2021 Shawn Bruce - Released under terms of the AGPLv3 License"
+
+import time
+
+FILTER_MAJORITY = 'MAJORITY'
+FILTER_STABLE = 'STABLE'
+
+
+class SampleWindow(object):
+    """The last ``size`` samples of one line packed into an int, newest in bit 0."""
+
+    __slots__ = ('size', 'mask', 'bits', 'count')
+
+    def __init__(self, size):
+        self.size = size
+        self.mask = (1 << size) - 1
+        self.bits = 0
+        self.count = 0
+
+    def add(self, value):
+        self.bits = ((self.bits << 1) | (1 if value else 0)) & self.mask
+        if self.count < self.size:
+            self.count += 1
+
+    def highs(self):
+        return bin(self.bits).count('1')
+
+    def lows(self):
+        return self.count - self.highs()
+
+    @property
+    def full(self):
+        return self.count == self.size
+
+    @property
+    def stable(self):
+        # Every sample in a full window has the same level.
+        return self.full and (self.bits == 0 or self.bits == self.mask)
+
+    @property
+    def newest(self):
+        return bool(self.bits & 1)
+
+
+class SenseFilter(object):
+    """
+    Debounces GPIO sense lines over a burst of reads.
+
+    FILTER_MAJORITY takes ``samples`` reads and accepts a level once at least
+    ``threshold`` of them agree. FILTER_STABLE keeps reading until the level
+    has not changed for ``stable_time`` seconds, giving up after four times
+    that. Until a new level passes the filter the previously accepted one is
+    kept and the burst counts as a rejected glitch for every line that saw a
+    deviating sample.
+    """
+
+    def __init__(self, mode, samples, threshold, stable_time, interval):
+        self.mode = mode
+        self.interval = max(0.0, interval)
+
+        if mode == FILTER_STABLE:
+            # Enough samples at the burst rate to span the stable time.
+            size = 2
+            if self.interval > 0:
+                size = int(round(stable_time / self.interval)) + 1
+            self.window_size = max(2, size)
+            self.max_samples = self.window_size * 4
+            self.threshold = self.window_size
+        else:
+            self.window_size = max(1, samples)
+            self.max_samples = self.window_size
+            self.threshold = min(max(threshold, self.window_size // 2 + 1), self.window_size)
+
+        self.params = (mode, samples, threshold, stable_time, interval)
+        self.accepted = dict()
+        self.rejected = dict()
+        self.glitches = []
+        self.settled = True
+
+
+    def filter(self, read):
+        """
+        ``read()`` returns ``{key: level}`` for every sensed line. Returns the
+        accepted level of each line.
+        """
+        windows = dict()
+        deviated = set()
+
+        for i in range(self.max_samples):
+            if i > 0 and self.interval > 0:
+                time.sleep(self.interval)
+
+            for key, level in read().items():
+                window = windows.get(key)
+                if window is None:
+                    window = windows[key] = SampleWindow(self.window_size)
+                window.add(level)
+
+                if key in self.accepted and bool(level) != self.accepted[key]:
+                    deviated.add(key)
+
+            if i + 1 >= self.window_size and self._decided(windows):
+                break
+
+        settled = True
+        self.glitches = []
+        for key, window in windows.items():
+            previous = self.accepted.get(key)
+            level = self._decide(window)
+
+            if level is None:
+                if key not in self.accepted:
+                    # Nothing accepted yet, go with the majority rather than reporting nothing.
+                    self.accepted[key] = window.highs() * 2 > window.count
+                settled = False
+            else:
+                self.accepted[key] = level
+
+            if key in deviated and self.accepted[key] == previous:
+                self.rejected[key] = self.rejected.get(key, 0) + 1
+                self.glitches.append(key)
+
+            if window.newest != self.accepted[key]:
+                settled = False
+
+        self.settled = settled
+        return dict((key, self.accepted[key]) for key in windows)
+
+
+    def _decide(self, window):
+        if self.mode == FILTER_STABLE:
+            return window.newest if window.stable else None
+
+        if window.highs() >= self.threshold:
+            return True
+        elif window.lows() >= self.threshold:
+            return False
+
+        return None
+
+
+    def _decided(self, windows):
+        if self.mode != FILTER_STABLE:
+            return True
+
+        return all(window.stable for window in windows.values())
@@ -0,0 +1,317 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Shawn Bruce <kantlivelong@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2021 Shawn Bruce - Released under terms of the AGPLv3 License"
+
+import os
+import select
+import signal
+import subprocess
+import threading
+import time
+
+from octoprint.util import fqfn
+
+
+class ExecutionResult(object):
+    __slots__ = ('value', 'returncode', 'timed_out', 'busy', 'error', 'duration')
+
+    def __init__(self, value=None, returncode=None, timed_out=False, busy=False, error=None, duration=0.0):
+        self.value = value
+        self.returncode = returncode
+        self.timed_out = timed_out
+        self.busy = busy
+        self.error = error
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return not (self.timed_out or self.busy or self.error is not None)
+
+
+def _wait_process(p, timeout):
+    # Block on the process itself rather than polling when the kernel allows it (Linux >= 5.3).
+    pidfd_open = getattr(os, 'pidfd_open', None)
+    if pidfd_open is not None:
+        try:
+            fd = pidfd_open(p.pid)
+        except OSError:
+            fd = None
+
+        if fd is not None:
+            try:
+                poller = select.poll()
+                poller.register(fd, select.POLLIN)
+                if not poller.poll(None if timeout is None else timeout * 1000):
+                    raise subprocess.TimeoutExpired(p.args, timeout)
+            finally:
+                os.close(fd)
+
+    return p.wait(timeout)
+
+
+class PersistentCommand(object):
+    """
+    A helper process that is started once and queried over a line protocol.
+
+    Each query writes ``state`` to the helper's stdin and expects a single line
+    back on stdout: ``on`` or ``off``. Anything else is reported as an error.
+    The helper should exit when its stdin is closed. Queries and stop() may be
+    called from different threads; once stopped, queries fail rather than
+    starting the helper again.
+    """
+
+    REQUEST = b'state\n'
+
+    def __init__(self, logger, key, command):
+        self._logger = logger
+        self.key = key
+        self.command = command
+        self._process = None
+        self._buffer = b''
+        self._lock = threading.Lock()
+        self._closed = False
+
+
+    @property
+    def running(self):
+        return self._process is not None and self._process.poll() is None
+
+
+    def start(self):
+        self._process = subprocess.Popen(self.command, shell=True, start_new_session=True,
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+        self._buffer = b''
+        self._logger.info("{} persistent command started. PID={}, Command={}".format(self.key, self._process.pid, self.command))
+
+
+    def stop(self):
+        with self._lock:
+            self._closed = True
+            self._stop()
+
+
+    def reset(self):
+        """Stops the helper, the next query starts it again."""
+        with self._lock:
+            self._stop()
+
+
+    def _stop(self):
+        p = self._process
+        self._process = None
+        if p is None:
+            return
+
+        try:
+            p.stdin.close()
+        except Exception:
+            pass
+
+        try:
+            _wait_process(p, 1.0)
+        except subprocess.TimeoutExpired:
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            p.wait()
+
+        p.stdout.close()
+        self._logger.debug("{} persistent command stopped. PID={}".format(self.key, p.pid))
+
+
+    def _readline(self, deadline):
+        fd = self._process.stdout.fileno()
+        while b'\n' not in self._buffer:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise subprocess.TimeoutExpired(self.command, None)
+
+            r, _, _ = select.select([fd], [], [], remaining)
+            if not r:
+                raise subprocess.TimeoutExpired(self.command, None)
+
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                raise EOFError("Persistent command closed its output")
+            self._buffer += chunk
+
+        line, _, self._buffer = self._buffer.partition(b'\n')
+        return line.decode('utf-8', 'replace').strip().lower()
+
+
+    def query(self, timeout=None):
+        with self._lock:
+            if self._closed:
+                return ExecutionResult(error=RuntimeError("{} persistent command was stopped".format(self.key)))
+
+            return self._query(timeout)
+
+
+    def _query(self, timeout):
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+
+        if not self.running:
+            if self._process is not None:
+                self._logger.warning("{} persistent command exited with {}. Restarting.".format(self.key, self._process.returncode))
+                self._stop()
+            self.start()
+
+        try:
+            self._process.stdin.write(self.REQUEST)
+            line = self._readline(deadline)
+        except subprocess.TimeoutExpired:
+            self._logger.error("{} persistent command did not answer within {}s. Restarting it.".format(self.key, timeout))
+            self._stop()
+            return ExecutionResult(timed_out=True, duration=time.monotonic() - start)
+        except (EOFError, OSError) as e:
+            self._logger.error("{} persistent command failed: {}".format(self.key, e))
+            self._stop()
+            return ExecutionResult(error=e, duration=time.monotonic() - start)
+
+        if line == 'on':
+            value = True
+        elif line == 'off':
+            value = False
+        else:
+            self._logger.error("{} persistent command returned an unexpected response: {}".format(self.key, line))
+            return ExecutionResult(error=ValueError(line), duration=time.monotonic() - start)
+
+        self._logger.debug("{} persistent command returned: {}".format(self.key, line))
+        return ExecutionResult(value=value, duration=time.monotonic() - start)
+
+
+class Executor(object):
+    """
+    Runs system commands and sub-plugin callbacks with a deadline.
+
+    Commands are started in their own process group so a timed out command is
+    killed together with anything it spawned. Callbacks run on a worker thread;
+    one that misses its deadline is abandoned and further calls with the same
+    key are refused until it returns, so a hung backend can't pile up threads.
+    """
+
+    def __init__(self, logger):
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._in_flight = dict()
+        self._persistent = dict()
+        self.durations = dict()
+
+
+    def _record(self, key, result):
+        self.durations[key] = result.duration
+        self._logger.debug("{} took {:.1f}ms".format(key, result.duration * 1000))
+        return result
+
+
+    def run_command(self, key, command, timeout=None):
+        if timeout is not None and timeout <= 0:
+            timeout = None
+
+        start = time.monotonic()
+        try:
+            p = subprocess.Popen(command, shell=True, start_new_session=True)
+        except Exception as e:
+            self._logger.exception("Exception while executing {} system command: {}".format(key, command))
+            return self._record(key, ExecutionResult(error=e, duration=time.monotonic() - start))
+
+        self._logger.debug("{} system command executed. PID={}, Command={}".format(key, p.pid, command))
+
+        try:
+            r = _wait_process(p, timeout)
+        except subprocess.TimeoutExpired:
+            self._logger.error("{} system command timed out after {}s, killing it. PID={}, Command={}".format(key, timeout, p.pid, command))
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            p.wait()
+            return self._record(key, ExecutionResult(returncode=p.returncode, timed_out=True, duration=time.monotonic() - start))
+
+        self._logger.debug("{} system command returned: {}".format(key, r))
+        return self._record(key, ExecutionResult(returncode=r, duration=time.monotonic() - start))
+
+
+    def run_callback(self, key, callback, timeout=None):
+        if timeout is not None and timeout <= 0:
+            timeout = None
+
+        with self._lock:
+            if key in self._in_flight:
+                self._logger.warning("Previous {} call to {} has not returned yet. Skipping.".format(key, callback))
+                return ExecutionResult(busy=True)
+
+            result = ExecutionResult()
+            done = threading.Event()
+            self._in_flight[key] = done
+
+        start = time.monotonic()
+
+        def run():
+            try:
+                result.value = callback()
+            except Exception as e:
+                result.error = e
+                self._logger.exception(
+                    "Error while executing callback {}".format(
+                        callback
+                    ),
+                    extra={"callback": fqfn(callback)},
+                )
+            finally:
+                result.duration = time.monotonic() - start
+                with self._lock:
+                    self._in_flight.pop(key, None)
+                done.set()
+
+        thread = threading.Thread(target=run, name="PSUControl {}".format(key))
+        thread.daemon = True
+        thread.start()
+
+        if not done.wait(timeout):
+            self._logger.error("Callback {} did not return within {}s".format(callback, timeout))
+            return self._record(key, ExecutionResult(timed_out=True, duration=time.monotonic() - start))
+
+        return self._record(key, result)
+
+
+    def run_persistent(self, key, command, timeout=None):
+        if timeout is not None and timeout <= 0:
+            timeout = None
+
+        with self._lock:
+            persistent = old = self._persistent.get(key)
+            if persistent is None or persistent.command != command:
+                persistent = self._persistent[key] = PersistentCommand(self._logger, key, command)
+
+        if old is not None and old is not persistent:
+            old.stop()
+
+        try:
+            result = persistent.query(timeout)
+        except Exception as e:
+            self._logger.exception("Exception while querying {} persistent command: {}".format(key, command))
+            persistent.reset()
+            result = ExecutionResult(error=e)
+
+        return self._record(key, result)
+
+
+    def persistent_keys(self):
+        with self._lock:
+            return list(self._persistent.keys())
+
+
+    def stop_persistent(self, key=None):
+        with self._lock:
+            keys = list(self._persistent.keys()) if key is None else [key]
+            stopped = [self._persistent.pop(k) for k in keys if k in self._persistent]
+
+        # Waits for a query in progress to finish first.
+        for persistent in stopped:
+            persistent.stop()
@@ -0,0 +1,261 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Shawn Bruce <kantlivelong@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2021 Shawn Bruce - Released under terms of the AGPLv3 License"
+
+import ctypes
+import fcntl
+import os
+import select
+
+import periphery
+
+try:
+    from periphery import gpio_cdev2
+except ImportError:
+    # Older python-periphery has no v2 uAPI support, every line is opened through CdevGPIO.
+    gpio_cdev2 = None
+
+# Line requests are built from periphery's private ctypes structures and ioctl numbers.
+# Should a release drop any of them every line is opened through CdevGPIO as well.
+_CDEV2_STRUCTS = ('_CGpioV2LineRequest', '_CGpioV2LineValues', '_CGpioV2LineEvent')
+_CDEV2_CONSTANTS = ('SUPPORTED', '_GPIO_V2_GET_LINE_IOCTL', '_GPIO_V2_LINE_GET_VALUES_IOCTL', '_GPIO_V2_LINE_SET_VALUES_IOCTL',
+                    '_GPIO_V2_LINE_FLAG_INPUT', '_GPIO_V2_LINE_FLAG_OUTPUT', '_GPIO_V2_LINE_FLAG_EDGE_RISING',
+                    '_GPIO_V2_LINE_FLAG_EDGE_FALLING', '_GPIO_V2_LINE_FLAG_BIAS_PULL_UP', '_GPIO_V2_LINE_FLAG_BIAS_PULL_DOWN',
+                    '_GPIO_V2_LINE_FLAG_BIAS_DISABLED', '_GPIO_V2_LINE_ATTR_ID_OUTPUT_VALUES')
+
+if gpio_cdev2 is not None and not (all(hasattr(gpio_cdev2, name) for name in _CDEV2_STRUCTS) and
+                                   all(hasattr(getattr(gpio_cdev2, 'Cdev2GPIO', None), name) for name in _CDEV2_CONSTANTS)):
+    gpio_cdev2 = None
+
+_GPIO_V2_LINE_ATTR_ID_FLAGS = 0x1
+
+if gpio_cdev2 is not None:
+    _Cdev2GPIO = gpio_cdev2.Cdev2GPIO
+
+    _BIAS_FLAGS = {
+        'pull_up': _Cdev2GPIO._GPIO_V2_LINE_FLAG_BIAS_PULL_UP,
+        'pull_down': _Cdev2GPIO._GPIO_V2_LINE_FLAG_BIAS_PULL_DOWN,
+        'disable': _Cdev2GPIO._GPIO_V2_LINE_FLAG_BIAS_DISABLED,
+    }
+
+    _EDGE_FLAGS = _Cdev2GPIO._GPIO_V2_LINE_FLAG_EDGE_RISING | _Cdev2GPIO._GPIO_V2_LINE_FLAG_EDGE_FALLING
+else:
+    _Cdev2GPIO = None
+
+
+class GPIOLineGroup(object):
+    """
+    A set of lines on one GPIO chip, held by a single line request.
+
+    All input lines are read with one GPIO_V2_LINE_GET_VALUES ioctl and edge
+    events for all of them arrive on one file descriptor. Kernels older than
+    5.10 lack the v2 uAPI, as does python-periphery before 2.4; there each
+    line is opened on its own through periphery.CdevGPIO behind the same
+    interface.
+    """
+
+    def __init__(self, path, consumer="psucontrol"):
+        self.path = path
+        self.consumer = consumer
+        self._offsets = []
+        self._inputs = dict()
+        self._outputs = dict()
+        self._fd = None
+        self._pins = None
+
+
+    def _add(self, offset):
+        if offset in self._offsets:
+            raise ValueError("GPIO line {} on {} is already in use".format(offset, self.path))
+        self._offsets.append(offset)
+
+
+    def add_input(self, offset, bias='default', edge=False):
+        self._add(offset)
+        self._inputs[offset] = (bias, edge)
+
+
+    def add_output(self, offset, initial=False):
+        self._add(offset)
+        self._outputs[offset] = initial
+
+
+    def output_level(self, offset):
+        """The level an output line was last set to, or its initial level."""
+        return self._outputs[offset]
+
+
+    def has_edge(self, offset):
+        return self._inputs.get(offset, (None, False))[1]
+
+
+    @property
+    def has_inputs(self):
+        return len(self._inputs) > 0
+
+
+    @property
+    def fds(self):
+        if self._pins is not None:
+            return [pin.fd for offset, pin in self._pins.items() if self.has_edge(offset)]
+
+        if self._fd is not None and any(edge for _, edge in self._inputs.values()):
+            return [self._fd]
+
+        return []
+
+
+    def open(self):
+        try:
+            self._open()
+        except (OSError, IOError, periphery.GPIOError):
+            if not any(edge for _, edge in self._inputs.values()):
+                raise
+
+            # Not every chip can deliver edge events, retry with plain inputs.
+            # Callers can tell which lines lost edge detection from has_edge().
+            self.close()
+            self._inputs = dict((offset, (bias, False)) for offset, (bias, _) in self._inputs.items())
+            self._open()
+
+
+    def _open(self):
+        if _Cdev2GPIO is None or not _Cdev2GPIO.SUPPORTED:
+            self._open_per_line()
+            return
+
+        request = gpio_cdev2._CGpioV2LineRequest()
+        flag_masks = []
+        output_mask = 0
+        output_values = 0
+
+        for i, offset in enumerate(self._offsets):
+            bit = 1 << i
+            request.offsets[i] = offset
+
+            if offset in self._outputs:
+                flags = _Cdev2GPIO._GPIO_V2_LINE_FLAG_OUTPUT
+                output_mask |= bit
+                if self._outputs[offset]:
+                    output_values |= bit
+            else:
+                bias, edge = self._inputs[offset]
+                flags = _Cdev2GPIO._GPIO_V2_LINE_FLAG_INPUT | _BIAS_FLAGS.get(bias, 0)
+                if edge:
+                    flags |= _EDGE_FLAGS
+
+            for entry in flag_masks:
+                if entry[0] == flags:
+                    entry[1] |= bit
+                    break
+            else:
+                flag_masks.append([flags, bit])
+
+        # The first flag set is the default, the rest are applied to their lines through attributes.
+        request.config.flags = flag_masks[0][0]
+        num_attrs = 0
+        for flags, mask in flag_masks[1:]:
+            attr = request.config.attrs[num_attrs]
+            attr.attr.id = _GPIO_V2_LINE_ATTR_ID_FLAGS
+            attr.attr.data.flags = flags
+            attr.mask = mask
+            num_attrs += 1
+
+        if output_mask:
+            attr = request.config.attrs[num_attrs]
+            attr.attr.id = _Cdev2GPIO._GPIO_V2_LINE_ATTR_ID_OUTPUT_VALUES
+            attr.attr.data.values = output_values
+            attr.mask = output_mask
+            num_attrs += 1
+
+        request.config.num_attrs = num_attrs
+        request.num_lines = len(self._offsets)
+        request.consumer = self.consumer.encode()
+
+        chip_fd = os.open(self.path, 0)
+        try:
+            fcntl.ioctl(chip_fd, _Cdev2GPIO._GPIO_V2_GET_LINE_IOCTL, request)
+        finally:
+            os.close(chip_fd)
+
+        self._fd = request.fd
+
+
+    def _open_per_line(self):
+        self._pins = dict()
+        for offset in self._offsets:
+            if offset in self._outputs:
+                self._pins[offset] = periphery.CdevGPIO(self.path, offset, 'high' if self._outputs[offset] else 'low')
+            else:
+                bias, edge = self._inputs[offset]
+                self._pins[offset] = periphery.CdevGPIO(path=self.path, line=offset, direction='in',
+                                                        edge='both' if edge else 'none', bias=bias)
+
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+        if self._pins is not None:
+            pins = self._pins
+            self._pins = None
+            for pin in pins.values():
+                pin.close()
+
+
+    def read(self):
+        """Returns the raw level of every input line, keyed by line offset."""
+        if self._pins is not None:
+            return dict((offset, self._pins[offset].read()) for offset in self._inputs)
+
+        values = gpio_cdev2._CGpioV2LineValues()
+        for i, offset in enumerate(self._offsets):
+            if offset in self._inputs:
+                values.mask |= 1 << i
+
+        fcntl.ioctl(self._fd, _Cdev2GPIO._GPIO_V2_LINE_GET_VALUES_IOCTL, values)
+
+        return dict((offset, bool((values.bits >> i) & 1))
+                    for i, offset in enumerate(self._offsets) if offset in self._inputs)
+
+
+    def write(self, offset, value):
+        if self._pins is not None:
+            self._pins[offset].write(value)
+            self._outputs[offset] = bool(value)
+            return
+
+        i = self._offsets.index(offset)
+        values = gpio_cdev2._CGpioV2LineValues()
+        values.mask = 1 << i
+        values.bits = (1 << i) if value else 0
+
+        fcntl.ioctl(self._fd, _Cdev2GPIO._GPIO_V2_LINE_SET_VALUES_IOCTL, values)
+        self._outputs[offset] = bool(value)
+
+
+    def read_events(self):
+        """Drains queued edge events and returns the offsets they were reported for."""
+        changed = set()
+
+        if self._pins is not None:
+            for offset, pin in self._pins.items():
+                if not self.has_edge(offset):
+                    continue
+                while pin.poll(0):
+                    pin.read_event()
+                    changed.add(offset)
+            return changed
+
+        size = ctypes.sizeof(gpio_cdev2._CGpioV2LineEvent)
+        while select.select([self._fd], [], [], 0)[0]:
+            buf = os.read(self._fd, size * 16)
+            for start in range(0, len(buf) - size + 1, size):
+                event = gpio_cdev2._CGpioV2LineEvent.from_buffer_copy(buf[start:start + size])
+                changed.add(event.offset)
+
+        return changed
@@ -0,0 +1,181 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Shawn Bruce <kantlivelong@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2021 Shawn Bruce - Released under terms of the AGPLv3 License"
+
+import datetime
+import math
+import os
+import struct
+import threading
+import time
+
+CAUSE_UNKNOWN = 'unknown'
+CAUSE_EXTERNAL = 'external'
+CAUSE_STARTUP = 'startup'
+CAUSE_SHUTDOWN = 'shutdown'
+CAUSE_API = 'api'
+CAUSE_AUTO_ON = 'auto_on'
+CAUSE_IDLE = 'idle'
+CAUSE_ERROR = 'error'
+CAUSE_GCODE = 'gcode'
+CAUSE_UPLOAD = 'upload'
+CAUSE_PLUGIN = 'plugin'
+
+# Stored as an index, only ever append to this.
+CAUSES = (CAUSE_UNKNOWN, CAUSE_EXTERNAL, CAUSE_STARTUP, CAUSE_SHUTDOWN, CAUSE_API, CAUSE_AUTO_ON,
+          CAUSE_IDLE, CAUSE_ERROR, CAUSE_GCODE, CAUSE_UPLOAD, CAUSE_PLUGIN)
+
+STATE_UNKNOWN = -1
+
+_HEADER = struct.Struct('<4sBII')
+_MAGIC = b'PSUH'
+_VERSION = 1
+
+# time (epoch seconds), state (1/0/-1), cause index, switch latency in seconds (NaN if none)
+_RECORD = struct.Struct('<dbBf')
+
+
+class PowerHistory(object):
+    """
+    Fixed size ring buffer of PSU state transitions.
+
+    Records are packed into one preallocated bytearray, so memory use doesn't
+    grow and saving is a single write. Times are wall clock so entries stay
+    meaningful across restarts; a ``shutdown`` entry with an unknown state
+    marks the time PSUControl wasn't watching.
+    """
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self._buffer = bytearray(capacity * _RECORD.size)
+        self._start = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self.dirty = False
+
+
+    def __len__(self):
+        return self._count
+
+
+    def append(self, state, cause=CAUSE_UNKNOWN, latency=None, t=None):
+        if t is None:
+            t = time.time()
+
+        record = (t,
+                  STATE_UNKNOWN if state is None else int(bool(state)),
+                  CAUSES.index(cause) if cause in CAUSES else 0,
+                  float('nan') if latency is None else latency)
+
+        with self._lock:
+            if self._count < self.capacity:
+                i = (self._start + self._count) % self.capacity
+                self._count += 1
+            else:
+                i = self._start
+                self._start = (self._start + 1) % self.capacity
+
+            _RECORD.pack_into(self._buffer, i * _RECORD.size, *record)
+            self.dirty = True
+
+
+    def _records(self):
+        with self._lock:
+            start, count = self._start, self._count
+            data = bytes(self._buffer)
+
+        for n in range(count):
+            yield _RECORD.unpack_from(data, ((start + n) % self.capacity) * _RECORD.size)
+
+
+    def entries(self, start=None, end=None):
+        result = []
+        for t, state, cause, latency in self._records():
+            if (start is not None and t < start) or (end is not None and t >= end):
+                continue
+
+            result.append(dict(time=t,
+                               isPSUOn=None if state == STATE_UNKNOWN else bool(state),
+                               cause=CAUSES[cause] if cause < len(CAUSES) else CAUSE_UNKNOWN,
+                               latency=None if math.isnan(latency) else round(latency, 3)))
+        return result
+
+
+    def on_time_per_day(self, start, end, now=None):
+        """Seconds the PSU was on per local calendar day between start and end."""
+        if now is None:
+            now = time.time()
+        end = min(end, now)
+
+        # The end is exclusive, a range ending at midnight doesn't reach into the next day.
+        last = datetime.date.fromtimestamp(max(start, end))
+        if end > start and time.mktime(last.timetuple()) == end:
+            last -= datetime.timedelta(days=1)
+
+        days = dict()
+        day = datetime.date.fromtimestamp(start)
+        while day <= last:
+            days[day.isoformat()] = 0.0
+            day += datetime.timedelta(days=1)
+
+        records = list(self._records())
+        for i, (t, state, _, _) in enumerate(records):
+            if state != 1:
+                continue
+
+            until = records[i + 1][0] if i + 1 < len(records) else now
+            self._add_interval(days, max(t, start), min(until, end))
+
+        return [dict(date=d, onSeconds=round(s, 1)) for d, s in sorted(days.items())]
+
+
+    @staticmethod
+    def _add_interval(days, a, b):
+        while a < b:
+            day = datetime.date.fromtimestamp(a)
+            midnight = time.mktime((day + datetime.timedelta(days=1)).timetuple())
+            until = min(b, midnight)
+            key = day.isoformat()
+            if key in days:
+                days[key] += until - a
+            a = until
+
+
+    def save(self, path):
+        with self._lock:
+            start, count = self._start, self._count
+            data = bytes(self._buffer)
+            self.dirty = False
+
+        # Written oldest first so loading doesn't depend on the capacity it was saved with.
+        head = data[start * _RECORD.size:]
+        tail = data[:start * _RECORD.size]
+        ordered = (head + tail)[:count * _RECORD.size]
+
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, _RECORD.size, count))
+            f.write(ordered)
+        os.replace(tmp, path)
+
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            magic, version, size, count = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC or version != _VERSION or size != _RECORD.size:
+                raise ValueError("Unsupported history file {}".format(path))
+
+            data = f.read(count * size)
+
+        count = len(data) // size
+        skip = max(0, count - self.capacity)
+
+        with self._lock:
+            self._buffer[:] = bytearray(self.capacity * size)
+            self._buffer[:(count - skip) * size] = data[skip * size:count * size]
+            self._start = 0
+            self._count = count - skip
+            self.dirty = False
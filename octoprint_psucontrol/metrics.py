@@ -0,0 +1,130 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Shawn Bruce <kantlivelong@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2021 Shawn Bruce - Released under terms of the AGPLv3 License"
+
+import bisect
+import threading
+
+# Updates are plain attribute increments without locking so they stay cheap
+# enough for the G-code hook. Concurrent updates of the same series from
+# different threads may occasionally lose a count.
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+SWITCH_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+HOOK_BUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.001)
+
+
+class Counter(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append('{}="{}"'.format(*extra))
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class MetricFamily(object):
+    def __init__(self, name, documentation, kind, labelnames, factory):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self._factory = factory
+        self._children = dict()
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._factory())
+        return child
+
+    def render(self, lines):
+        lines.append("# HELP {} {}".format(self.name, self.documentation))
+        lines.append("# TYPE {} {}".format(self.name, self.kind))
+
+        for values, child in sorted(self._children.items()):
+            if self.kind == 'histogram':
+                cumulative = 0
+                for bound, count in zip(child.buckets, child.counts):
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(self.name, _format_labels(self.labelnames, values, ('le', repr(float(bound)))), cumulative))
+                lines.append("{}_bucket{} {}".format(self.name, _format_labels(self.labelnames, values, ('le', '+Inf')), child.count))
+                lines.append("{}_sum{} {!r}".format(self.name, _format_labels(self.labelnames, values), float(child.sum)))
+                lines.append("{}_count{} {}".format(self.name, _format_labels(self.labelnames, values), child.count))
+            else:
+                lines.append("{}{} {}".format(self.name, _format_labels(self.labelnames, values), child.value))
+
+
+class Registry(object):
+    """Collects metric families and renders them in the Prometheus text format."""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, prefix="psucontrol_"):
+        self.prefix = prefix
+        self._families = []
+
+    def _add(self, family):
+        self._families.append(family)
+        return family
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(MetricFamily(self.prefix + name, documentation, 'counter', labelnames, Counter))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._add(MetricFamily(self.prefix + name, documentation, 'gauge', labelnames, Gauge))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        buckets = tuple(sorted(buckets))
+        return self._add(MetricFamily(self.prefix + name, documentation, 'histogram', labelnames, lambda: Histogram(buckets)))
+
+    def render(self):
+        lines = []
+        for family in self._families:
+            family.render(lines)
+        return '\n'.join(lines) + '\n'
@@ -14,6 +14,24 @@ $(function() {
         self.scripts_gcode_psucontrol_pre_off = ko.observable(undefined);
 
         self.isPSUOn = ko.observable(undefined);
+        self.psuState = ko.observable(undefined);
+        self.cooldownEta = ko.observable(null);
+        self.cooldownTimer = undefined;
+        self.cooldownText = ko.pureComputed(function() {
+            var eta = self.cooldownEta();
+            if (eta === null || eta === undefined) {
+                return "";
+            }
+
+            var seconds = Math.ceil(eta);
+            return Math.floor(seconds / 60) + ":" + ("0" + (seconds % 60)).slice(-2);
+        });
+        self.isSwitching = ko.pureComputed(function() {
+            var state = self.psuState();
+            return state !== undefined && state !== "ON" && state !== "OFF";
+        });
+        self.stateSeq = undefined;
+        self.resyncPending = false;
 
         self.psu_indicator = $("#psucontrol_indicator");
 
@@ -81,6 +99,14 @@ $(function() {
                 }   
             });
 
+            self.isSwitching.subscribe(function() {
+                self.psu_indicator.toggleClass("switching", self.isSwitching());
+            });
+
+            self.requestPSUState();
+        }
+
+        self.requestPSUState = function() {
             $.ajax({
                 url: API_BASEURL + "plugin/psucontrol",
                 type: "POST",
@@ -90,15 +116,65 @@ $(function() {
                 }),
                 contentType: "application/json; charset=UTF-8"
             }).done(function(data) {
+                self.stateSeq = data.seq;
+                self.psuState(data.state);
+                self.setCooldownEta(data.cooldownEta);
                 self.isPSUOn(data.isPSUOn);
+            }).always(function() {
+                self.resyncPending = false;
             });
-        }
+        };
+
+        self.setCooldownEta = function(eta) {
+            if (self.cooldownTimer !== undefined) {
+                clearInterval(self.cooldownTimer);
+                self.cooldownTimer = undefined;
+            }
+
+            self.cooldownEta(eta === undefined ? null : eta);
+            if (eta === null || eta === undefined) {
+                return;
+            }
+
+            // The server only sends a new estimate when it shifts noticeably, count down locally in between.
+            self.cooldownTimer = setInterval(function() {
+                self.cooldownEta(Math.max(0, self.cooldownEta() - 1));
+            }, 1000);
+        };
+
+        self.resyncPSUState = function() {
+            if (self.resyncPending) {
+                return;
+            }
+
+            self.resyncPending = true;
+            self.requestPSUState();
+        };
 
         self.onDataUpdaterPluginMessage = function(plugin, data) {
             if (plugin != "psucontrol") {
                 return;
             }
 
+            if (data.seq !== undefined) {
+                // A gap means we missed a change, possibly more than one. Fetch the current state once.
+                var missed = (self.stateSeq !== undefined && data.seq > self.stateSeq + 1);
+                self.stateSeq = data.seq;
+
+                if (missed) {
+                    self.resyncPSUState();
+                    return;
+                }
+            }
+
+            if (data.state !== undefined) {
+                self.psuState(data.state);
+            }
+
+            if (data.cooldownEta !== undefined) {
+                self.setCooldownEta(data.cooldownEta);
+            }
+
             if (data.isPSUOn !== undefined) {
                 self.isPSUOn(data.isPSUOn);
             }
@@ -145,6 +221,33 @@ $(function() {
             })
         };
 
+        self.addChannel = function() {
+            self.settings.plugins.psucontrol.channels.push(ko.mapping.fromJS({
+                name: "",
+                GPIODevice: "",
+                switchingMethod: "GPIO",
+                onoffGPIOPin: 0,
+                invertonoffGPIOPin: false,
+                onGCodeCommand: "",
+                offGCodeCommand: "",
+                onSysCommand: "",
+                offSysCommand: "",
+                switchingPlugin: "",
+                sensingMethod: "INTERNAL",
+                senseGPIOPin: 0,
+                invertsenseGPIOPin: false,
+                senseGPIOPinPUD: "",
+                senseGPIOPinEdgeDetection: true,
+                senseSystemCommand: "",
+                senseSystemCommandPersistent: false,
+                sensingPlugin: ""
+            }));
+        };
+
+        self.removeChannel = function(channel) {
+            self.settings.plugins.psucontrol.channels.remove(channel);
+        };
+
         self.subPluginTabExists = function(id) {
             return $('#settings_plugin_' + id).length > 0
         };
@@ -0,0 +1,145 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Shawn Bruce <kantlivelong@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2021 Shawn Bruce - Released under terms of the AGPLv3 License"
+
+import json
+
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.web
+from tornado.concurrent import Future
+
+
+class StateBroadcaster(object):
+    """
+    Wakes up streaming clients when the PSU state message changes.
+
+    publish() may be called from any thread. Waiters live on the Tornado IOLoop
+    and are only touched from it, so no locking is needed.
+    """
+
+    def __init__(self, get_state):
+        self._get_state = get_state
+        self._loop = None
+        self._waiters = set()
+
+
+    def current(self):
+        return self._get_state()
+
+
+    def publish(self):
+        loop = self._loop
+        if loop is not None:
+            loop.add_callback(self._notify)
+
+
+    def _notify(self):
+        message = self._get_state()
+        waiters, self._waiters = self._waiters, set()
+        for future in waiters:
+            if not future.done():
+                future.set_result(message)
+
+
+    async def wait(self, since, timeout):
+        self._loop = tornado.ioloop.IOLoop.current()
+
+        deadline = self._loop.time() + timeout
+
+        while True:
+            message = self._get_state()
+            if message['seq'] > since:
+                return message
+
+            future = Future()
+            self._waiters.add(future)
+            try:
+                await tornado.gen.with_timeout(deadline, future)
+            except tornado.gen.TimeoutError:
+                return self._get_state()
+            finally:
+                self._waiters.discard(future)
+
+
+class StateStreamHandler(tornado.web.RequestHandler):
+    """
+    Long-poll and Server-Sent Events endpoint for PSU state changes.
+
+    A plain GET returns the state once its sequence number is greater than
+    ``since``, or after ``timeout`` seconds with the unchanged state. With
+    ``Accept: text/event-stream`` the connection is kept open and every state
+    change is pushed as a ``psu_state`` event whose id is the sequence number.
+    """
+
+    KEEPALIVE_INTERVAL = 15
+
+    def initialize(self, broadcaster, access_validation=None, max_timeout=120):
+        self._broadcaster = broadcaster
+        self._access_validation = access_validation
+        self._max_timeout = max_timeout
+
+
+    def _get_int_argument(self, name, default):
+        value = self.get_query_argument(name, None)
+        if value is None:
+            return default
+
+        try:
+            return int(value)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Invalid {}: {}".format(name, value))
+
+
+    async def get(self):
+        if self._access_validation is not None:
+            self._access_validation(self.request)
+
+        self.set_header("Cache-Control", "no-cache")
+
+        if "text/event-stream" in self.request.headers.get("Accept", ""):
+            await self._stream()
+        else:
+            await self._long_poll()
+
+
+    async def _long_poll(self):
+        since = self._get_int_argument("since", -1)
+        timeout = min(max(self._get_int_argument("timeout", 30), 0), self._max_timeout)
+
+        message = self._broadcaster.current()
+        if message['seq'] <= since and timeout > 0:
+            message = await self._broadcaster.wait(since, timeout)
+
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(message))
+
+
+    async def _stream(self):
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("X-Accel-Buffering", "no")
+
+        last_id = self.request.headers.get("Last-Event-ID")
+        if last_id is not None and last_id.isdigit():
+            seq = int(last_id)
+        else:
+            seq = self._get_int_argument("since", -1)
+
+        message = self._broadcaster.current()
+
+        try:
+            while True:
+                if message['seq'] > seq:
+                    seq = message['seq']
+                    self.write("id: {}\nevent: psu_state\ndata: {}\n\n".format(seq, json.dumps(message)))
+                else:
+                    self.write(": keepalive\n\n")
+
+                await self.flush()
+                message = await self._broadcaster.wait(seq, self.KEEPALIVE_INTERVAL)
+        except tornado.iostream.StreamClosedError:
+            pass
@@ -0,0 +1,51 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Shawn Bruce <kantlivelong@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2021 Shawn Bruce - Released under terms of the AGPLv3 License"
+
+
+class SubPluginRegistration(object):
+    """
+    A registered sub-plugin with its callbacks resolved once at registration.
+
+    Callbacks the implementation does not define are None. Plugins registered
+    with ``push=True`` report their state through notify_psu_state() and are
+    only polled until they have reported once.
+
+    ``turn_psu_on_async``/``turn_psu_off_async`` are used instead of the plain
+    switching callbacks when defined. They must return straight away with a
+    completion handle, a ``concurrent.futures.Future`` or anything else with a
+    ``result(timeout)`` method. A result of False marks the switch as failed.
+    Returning None means the switch already completed.
+    """
+
+    CALLBACKS = ('get_psu_state', 'turn_psu_on', 'turn_psu_off', 'turn_psu_on_async', 'turn_psu_off_async')
+
+    __slots__ = CALLBACKS + ('identifier', 'implementation', 'push', 'state', '_on_notify')
+
+    def __init__(self, identifier, implementation, push=False, on_notify=None):
+        self.identifier = identifier
+        self.implementation = implementation
+        self.push = push
+        self.state = None
+        self._on_notify = on_notify
+
+        for name in self.CALLBACKS:
+            callback = getattr(implementation, name, None)
+            setattr(self, name, callback if callable(callback) else None)
+
+
+    def switch_callbacks(self, on):
+        """Returns (async callback, callback) for the requested target."""
+        if on:
+            return self.turn_psu_on_async, self.turn_psu_on
+        return self.turn_psu_off_async, self.turn_psu_off
+
+
+    def notify_psu_state(self, state):
+        self.state = bool(state)
+
+        if self._on_notify is not None:
+            self._on_notify(self)
@@ -1,51 +1,185 @@
 # coding=utf-8
+import collections
+import heapq
+import itertools
+import logging
+import math
 import threading
+import time
 
-class ResettableTimer(threading.Thread):
-    def __init__(self, interval, function, args=None, kwargs=None, on_reset=None, on_cancelled=None):
-        threading.Thread.__init__(self)
-        self._event = threading.Event()
-        self._mutex = threading.Lock()
-        self.is_reset = True
-
-        if args is None:
-            args = []
-        if kwargs is None:
-            kwargs = dict()
+class ScheduledJob(object):
+    __slots__ = ('deadline', 'function', 'args', 'kwargs', 'cancelled')
 
-        self.interval = interval
+    def __init__(self, deadline, function, args, kwargs):
+        self.deadline = deadline
         self.function = function
         self.args = args
         self.kwargs = kwargs
-        self.on_cancelled = on_cancelled
-        self.on_reset = on_reset
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler(object):
+    """
+    Runs deferred work for the plugin on a single thread.
+
+    Jobs are kept in a heap ordered by their monotonic deadline. Jobs must not
+    block; anything long running should hand off to its own thread.
+    """
+
+    def __init__(self, logger, name="PSUControl scheduler"):
+        self._logger = logger
+        self._name = name
+        self._condition = threading.Condition()
+        self._queue = []
+        self._counter = itertools.count()
+        self._thread = None
+
+    def schedule(self, delay, function, *args, **kwargs):
+        job = ScheduledJob(time.monotonic() + max(0, delay), function, args, kwargs)
+
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self._name)
+                self._thread.daemon = True
+                self._thread.start()
+
+            heapq.heappush(self._queue, (job.deadline, next(self._counter), job))
+            if self._queue[0][2] is job:
+                self._condition.notify()
+
+        return job
+
+    def _next_job(self):
+        with self._condition:
+            while True:
+                while self._queue and self._queue[0][2].cancelled:
+                    heapq.heappop(self._queue)
+
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+
+                remaining = self._queue[0][0] - time.monotonic()
+                if remaining <= 0:
+                    return heapq.heappop(self._queue)[2]
+
+                self._condition.wait(remaining)
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job.cancelled:
+                continue
+
+            try:
+                job.function(*job.args, **job.kwargs)
+            except Exception:
+                self._logger.exception("Error while executing scheduled job {}".format(job.function))
+
+
+class SwitchOperation(object):
+    """
+    Handle for a queued PSU switch request.
 
-    def run(self):
-        while self.is_reset:
-            with self._mutex:
-                self.is_reset = False
-            self._event.wait(self.interval)
+    Returned to the caller straight away; wait() blocks until the switch,
+    including any post on delay, has finished and returns whether it succeeded.
+    ``cause`` says what asked for the switch and ends up in the power history.
+    Requests for the state a channel is already switching to get the handle
+    of that switch, so the same handle can be shared by several callers.
+    """
 
-        if not self._event.isSet():
-            self.function(*self.args, **self.kwargs)
+    def __init__(self, target, channel=None, cause=None):
+        self.target = target
+        self.channel = channel
+        self.cause = cause
+        self.created = time.monotonic()
+        self.result = None
+        self._event = threading.Event()
+        self._mutex = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+        return self.result
+
+    def add_done_callback(self, callback):
         with self._mutex:
-            self._event.set()
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
 
-    def cancel(self):
+        callback(self)
+
+    def complete(self, result):
         with self._mutex:
+            self.result = result
             self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
 
-        if callable(self.on_cancelled):
-            self.on_cancelled()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logging.getLogger("octoprint.plugins.psucontrol").exception(
+                    "Error while executing callback {}".format(callback)
+                )
 
-    def reset(self, interval=None):
-        with self._mutex:
-            if interval:
-                self.interval = interval
 
-            self.is_reset = True
-            self._event.set()
-            self._event.clear()
+class CoolingEstimator(object):
+    """
+    Estimates how long heaters take to cool down to a threshold.
+
+    Assumes Newton's law of cooling, T(t) = ambient + (T0 - ambient) * e^(-kt),
+    so ln(T - ambient) is linear in t. k is fitted per heater by least squares
+    over the most recent samples and the slowest heater gives the estimate.
+    """
+
+    def __init__(self, ambient=25.0, window=120):
+        self.ambient = ambient
+        self.window = window
+        self._samples = dict()
+
+    def reset(self):
+        self._samples = dict()
+
+    def add(self, heater, t, temp):
+        samples = self._samples.get(heater)
+        if samples is None:
+            samples = self._samples[heater] = collections.deque(maxlen=self.window)
+        samples.append((t, temp))
+
+    def estimate(self, threshold):
+        ambient = min(self.ambient, threshold - 1.0)
+        eta = 0.0
+
+        for heater, samples in self._samples.items():
+            latest = samples[-1][1]
+            if latest <= threshold:
+                continue
+
+            points = [(t, math.log(temp - ambient)) for t, temp in samples if temp > ambient]
+            if len(points) < 3 or points[-1][0] - points[0][0] < 2.0:
+                return None
+
+            n = float(len(points))
+            mean_t = sum(t for t, _ in points) / n
+            mean_y = sum(y for _, y in points) / n
+            var_t = sum((t - mean_t) ** 2 for t, _ in points)
+            if var_t == 0:
+                return None
+
+            slope = sum((t - mean_t) * (y - mean_y) for t, y in points) / var_t
+            if slope >= 0:
+                # Not cooling (yet), no meaningful estimate.
+                return None
+
+            eta = max(eta, math.log((latest - ambient) / (threshold - ambient)) / -slope)
 
-        if callable(self.on_reset):
-            self.on_reset()
+        return eta